@@ -0,0 +1,226 @@
+"""Benchmarks for the KQSP CLI hot paths.
+
+Run as `python kqsp_cli.py bench` (or `python kqsp_bench.py`). Results are
+printed as JSON so runs can be diffed between releases to catch regressions.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+
+import kqsp_cli
+
+XOR_SIZES = [64, 1024, 16 * 1024, 256 * 1024, 4 * 1024 * 1024]
+FRAMING_SIZES = [16, 256, 4096]
+GROUP_SIZES = [1, 10, 100, 1000]
+STARTUP_RUNS = 7
+HEAVY_MODULES = ['aiortc', 'aiohttp', 'numpy', 'av']
+CLI_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'kqsp_cli.py')
+
+# --- Helpers ---
+def measure(fn, min_time=0.2):
+    """Calls fn() repeatedly for at least `min_time` seconds, returns seconds per call."""
+    calls = 0
+    start = time.perf_counter()
+    while True:
+        fn()
+        calls += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            return elapsed / calls
+
+# --- Startup ---
+def bench_startup(runs=STARTUP_RUNS):
+    """Times fresh interpreters importing the CLI and printing --help, in milliseconds."""
+    cwd = os.path.dirname(CLI_PATH)
+    commands = {
+        'import': [sys.executable, '-c', 'import kqsp_cli'],
+        'help': [sys.executable, CLI_PATH, '--help'],
+    }
+    results = []
+    for name, command in commands.items():
+        samples = []
+        for _ in range(runs):
+            start = time.perf_counter()
+            subprocess.run(command, cwd=cwd, check=True, stdout=subprocess.DEVNULL)
+            samples.append((time.perf_counter() - start) * 1000)
+        results.append({
+            'command': name,
+            'min_ms': min(samples),
+            'median_ms': statistics.median(samples),
+            'target_ms': kqsp_cli.STARTUP_TARGET_MS,
+        })
+    # Anything heavy pulled in by a plain import is a startup regression
+    probe = f"import sys, kqsp_cli; print(','.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))"
+    loaded = subprocess.run([sys.executable, '-c', probe], cwd=cwd, check=True, capture_output=True, text=True).stdout.strip()
+    return {'runs': results, 'heavy_modules_loaded': loaded.split(',') if loaded else []}
+
+def startup_ok(startup):
+    return not startup['heavy_modules_loaded'] and all(run['median_ms'] <= run['target_ms'] for run in startup['runs'])
+
+# --- Crypto ---
+def bench_xor_crypt(min_time):
+    results = []
+    key = os.urandom(32)
+    saved_np = kqsp_cli.load_numpy()
+    backends = [('numpy', saved_np), ('python', None)] if saved_np is not None else [('python', None)]
+    try:
+        for backend, np_module in backends:
+            kqsp_cli.np = np_module
+            for size in XOR_SIZES:
+                data = os.urandom(size)
+                per_call = measure(lambda: kqsp_cli.xor_crypt(data, key), min_time)
+                results.append({'backend': backend, 'size': size, 'us_per_op': per_call * 1e6, 'mb_per_s': size / per_call / 1e6})
+    finally:
+        kqsp_cli.np = saved_np
+    return results
+
+# --- Framing ---
+def bench_framing(min_time):
+    results = []
+    sender = f"K({kqsp_cli.MY_DISPLAY_ADDR})"
+    for size in FRAMING_SIZES:
+        ciphertext = os.urandom(size)
+
+        def json_round_trip():
+            message = json.dumps({'type': 'text', 'from': sender, 'text': ciphertext.decode('latin-1')})
+            json.loads(message)['text'].encode('latin-1')
+
+        def binary_round_trip():
+            message = kqsp_cli.encode_frame(kqsp_cli.FRAME_TEXT, 1, ciphertext)
+            bytes(kqsp_cli.decode_frame(message)[3])
+
+        json_wire = len(json.dumps({'type': 'text', 'from': sender, 'text': ciphertext.decode('latin-1')}).encode('utf-8'))
+        binary_wire = len(kqsp_cli.encode_frame(kqsp_cli.FRAME_TEXT, 1, ciphertext))
+        results.append({'format': 'json', 'size': size, 'wire_bytes': json_wire, 'us_per_op': measure(json_round_trip, min_time) * 1e6})
+        results.append({'format': 'binary', 'size': size, 'wire_bytes': binary_wire, 'us_per_op': measure(binary_round_trip, min_time) * 1e6})
+    return results
+
+# --- Group Key ---
+def bench_group_key(min_time):
+    results = []
+    for peers in GROUP_SIZES:
+        peer_ids = [f"{i >> 16 & 255}-{i >> 8 & 255}-{i & 255}-1" for i in range(peers)]
+
+        def cold_derive():
+            kqsp_cli.GroupKeyManager(kqsp_cli.MY_PEER_ID).set_members(peer_ids)
+
+        manager = kqsp_cli.GroupKeyManager(kqsp_cli.MY_PEER_ID)
+        manager.set_members(peer_ids)
+
+        def churn():
+            manager.add('churn-peer')
+            manager.discard('churn-peer')
+
+        results.append({
+            'peers': peers,
+            'cold_us_per_op': measure(cold_derive, min_time) * 1e6,
+            'churn_us_per_op': measure(churn, min_time) * 1e6 / 2,
+        })
+    return results
+
+# --- Loopback ---
+async def bench_loopback(messages, bulk_bytes):
+    """Two in-process RTCPeerConnections, descriptions exchanged directly (no network signaling)."""
+    from aiortc import RTCPeerConnection
+
+    key = os.urandom(32)
+    a, b = RTCPeerConnection(), RTCPeerConnection()
+    channel = a.createDataChannel('kqsp-chat')
+    received = {'count': 0, 'bytes': 0, 'target': 0}
+    done = asyncio.Event()
+
+    @b.on("datachannel")
+    def on_datachannel(remote):
+        @remote.on("message")
+        def on_message(message):
+            _, _, _, payload = kqsp_cli.decode_frame(message)
+            kqsp_cli.xor_crypt(payload, key)
+            received['count'] += 1
+            received['bytes'] += len(payload)
+            if received['count'] >= received['target']:
+                done.set()
+
+    try:
+        await a.setLocalDescription(await a.createOffer())
+        await b.setRemoteDescription(a.localDescription)
+        await b.setLocalDescription(await b.createAnswer())
+        await a.setRemoteDescription(b.localDescription)
+        opened = asyncio.Event()
+        channel.on("open", opened.set)
+        if channel.readyState != 'open':
+            await asyncio.wait_for(opened.wait(), 30)
+        sender = kqsp_cli.ChannelSender(channel)
+
+        async def run_phase(count, payload, bulk):
+            received.update(count=0, bytes=0, target=count)
+            done.clear()
+            start = time.perf_counter()
+            for seq in range(count):
+                await sender.send(kqsp_cli.encode_frame(kqsp_cli.FRAME_TEXT, seq, kqsp_cli.xor_crypt(payload, key)), bulk=bulk)
+            await asyncio.wait_for(done.wait(), 120)
+            return time.perf_counter() - start
+
+        chat_elapsed = await run_phase(messages, b'x' * 64, bulk=False)
+        chunk = os.urandom(kqsp_cli.FILE_CHUNK_SIZE)
+        chunks = max(1, bulk_bytes // len(chunk))
+        bulk_elapsed = await run_phase(chunks, chunk, bulk=True)
+        sender.close()
+        return {
+            'messages': messages,
+            'messages_per_s': messages / chat_elapsed,
+            'bulk_bytes': chunks * len(chunk),
+            'bulk_mb_per_s': chunks * len(chunk) / bulk_elapsed / 1e6,
+        }
+    finally:
+        await a.close()
+        await b.close()
+
+# --- Entry Point ---
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="kqsp_cli.py bench", description="Benchmark KQSP CLI hot paths")
+    parser.add_argument('--min-time', type=float, default=0.2, help='Minimum seconds to run each micro-benchmark')
+    parser.add_argument('--messages', type=int, default=2000, help='Chat messages to send in the loopback test')
+    parser.add_argument('--bulk-mb', type=float, default=8, help='Megabytes of bulk data to send in the loopback test')
+    parser.add_argument('--skip-loopback', action='store_true', help='Skip the RTCPeerConnection loopback test')
+    parser.add_argument('--skip-startup', action='store_true', help='Skip the cold start test')
+    parser.add_argument('--check-startup', action='store_true', help='Exit with status 1 if cold start misses STARTUP_TARGET_MS')
+    parser.add_argument('--output', '-o', help='Write the JSON results to this file instead of stdout')
+    args = parser.parse_args(argv)
+
+    # Measure cold start first, before this process warms the page cache with NumPy or aiortc
+    startup = None if args.skip_startup else bench_startup()
+    report = {
+        'version': 1,
+        'timestamp': time.time(),
+        'python': platform.python_version(),
+        'numpy': kqsp_cli.load_numpy() is not None,
+        'results': {
+            'xor_crypt': bench_xor_crypt(args.min_time),
+            'framing': bench_framing(args.min_time),
+            'group_key': bench_group_key(args.min_time),
+        },
+    }
+    if startup is not None:
+        report['results']['startup'] = startup
+    if not args.skip_loopback:
+        report['results']['loopback'] = asyncio.run(bench_loopback(args.messages, int(args.bulk_mb * 1e6)))
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+    if args.check_startup and startup is not None and not startup_ok(startup):
+        print(f"Cold start missed its {kqsp_cli.STARTUP_TARGET_MS} ms target", file=sys.stderr)
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,27 +1,35 @@
 import asyncio
+import base64
+import bisect
+import collections
+import concurrent.futures
+import errno
 import json
 import random
+import re
 import hashlib
+import itertools
+import struct
 import sys
-import ssl
+import threading
+import zlib
+import time
 import logging
+import mmap
 import os
+import signal
+import socket
+import stat
 import argparse
-from urllib.parse import urlparse # <-- Add this
+# aiortc, aiohttp and NumPy take ~0.5 s to import together, so each is imported
+# where it is first needed: aiortc when a connection or basic signaling starts,
+# aiohttp for WebSocket signaling or the daemon API, NumPy in load_numpy().
+# `--help` and the CPU benchmarks load none of them. `python kqsp_cli.py bench`
+# measures cold start against STARTUP_TARGET_MS.
+STARTUP_TARGET_MS = 250 # Cold `import kqsp_cli` or `--help`, was ~650 ms with eager imports
 
-from aiortc import RTCIceCandidate, RTCPeerConnection, RTCSessionDescription, MediaStreamTrack
-# Use specific signaling classes instead of the helper function
-from aiortc.contrib.signaling import BYE, CopyAndPasteSignaling, TcpSocketSignaling, UnixSocketSignaling
-# Import WebSocket signaling (assuming a basic implementation or one compatible with PeerJS server)
-# You might need a more specific implementation depending on the server
-from aiortc.contrib.signaling import add_signaling_arguments as basic_add_signaling_arguments
-from aiortc.contrib.signaling import create_signaling as basic_create_signaling
-# Let's try using a generic WebSocket approach first, might need refinement
-# from aiortc.contrib.signaling import Signalling # Base class, might need custom implementation <-- REMOVE THIS LINE
-import aiohttp # Need aiohttp for WebSocket client
 
-
-# --- K(addr) Generation & Global State ---
+# --- K(addr) Generation & Application State ---
 def generate_k_addr():
     """Generates a unique K(addr) ID and display string."""
     parts = [random.randint(0, 255) for _ in range(4)]
@@ -34,167 +42,1291 @@ ROOT = os.path.dirname(__file__)
 cert_file = os.path.join(ROOT, "cert.pem") # Placeholder for potential cert
 key_file = os.path.join(ROOT, "key.pem")   # Placeholder for potential key
 
-pcs = set() # Set of active RTCPeerConnection objects
-group_key = None
-message_queue = asyncio.Queue() # Async queue for received messages
-stop_event = asyncio.Event()
+group_key = None # Kept in sync with group_keys below
+relay_key = None # Kept in sync with relay_keys below
+
+class App:
+    """State for one client run, built by main() once the event loop is running."""
+    def __init__(self, log_signals=False, compression=True, relay=False):
+        self.messages = asyncio.Queue() # Received messages and system notices for the UI
+        self.stop_event = asyncio.Event()
+        self.log_signals = log_signals  # Echo every signaling frame into the UI (--log-signals)
+        self.compression = compression  # Offer payload compression to capable peers (--no-compression)
+        self.mesh = PeerManager()
+        self.relay = Relay(relay)
+        self.receive_pipeline = ReceivePipeline()
+        self.log_acks = LogAcks()
+        self.message_log = None # MessageLog when started with --message-log
+        self.live_audio = None  # LiveAudio when started with --live-audio
+        self.channel_senders = {} # RTCDataChannel -> ChannelSender
+        self.incoming_files = {}  # (peer_id or origin K(addr), transfer_id) -> IncomingFile
+        self.outgoing_files = {}  # transfer_id -> {peer_id: channel} still being sent to
+        relay_keys.subscribe(self._on_relay_key_change)
+        self._reaper = asyncio.get_running_loop().call_later(INCOMING_REAP_INTERVAL, self._reap)
+
+    def _on_relay_key_change(self, key):
+        self.relay.announce()
+
+    def _reap(self):
+        reap_incoming_files()
+        self._reaper = asyncio.get_running_loop().call_later(INCOMING_REAP_INTERVAL, self._reap)
+
+    def close(self):
+        """Drops what this run registered globally and anything still in flight."""
+        relay_keys.unsubscribe(self._on_relay_key_change)
+        self._reaper.cancel()
+        for sender in self.channel_senders.values():
+            sender.close()
+        self.channel_senders.clear()
+        for incoming in self.incoming_files.values(): # Only this run could have resumed them
+            incoming.abort()
+        self.incoming_files.clear()
+
+app = None # The running App, set by main()
+
+# --- Metrics ---
+# Counters and latency histograms over the hot paths. Recording is a dict
+# update, rendering happens only on /stats or when the JSONL sink snapshots.
+# Histograms take a lock, since decrypt and JSON decode timings are also
+# recorded from the decode pool's threads (see Receive Pipeline).
+LATENCY_BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+METRICS_SNAPSHOT_INTERVAL = 10.0 # Seconds between JSONL sink snapshots
+
+class Histogram:
+    """Fixed-bucket latency histogram (seconds), Prometheus style."""
+    __slots__ = ('counts', 'sum', 'count')
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1) # Last slot is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def copy(self):
+        other = Histogram()
+        other.counts, other.sum, other.count = list(self.counts), self.sum, self.count
+        return other
+
+class _Timer:
+    __slots__ = ('_histogram', '_lock', '_start')
+
+    def __init__(self, histogram, lock):
+        self._histogram = histogram
+        self._lock = lock
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self._start
+        with self._lock:
+            self._histogram.observe(elapsed)
+
+class MetricsRegistry:
+    """Holds counters, gauges and histograms keyed by (name, labels)."""
+    def __init__(self):
+        self.counters = collections.defaultdict(int)
+        self.gauges = {}
+        self.histograms = collections.defaultdict(Histogram)
+        self._lock = threading.Lock() # Guards histograms
+
+    def inc(self, name, amount=1, **labels):
+        self.counters[name, tuple(sorted(labels.items()))] += amount
+
+    def set_gauge(self, name, value, **labels):
+        self.gauges[name, tuple(sorted(labels.items()))] = value
+
+    def observe(self, name, seconds, **labels):
+        with self._lock:
+            self.histograms[name, tuple(sorted(labels.items()))].observe(seconds)
+
+    def timer(self, name, **labels):
+        """Context manager that records the elapsed time of its block. Thread-safe."""
+        with self._lock:
+            histogram = self.histograms[name, tuple(sorted(labels.items()))]
+        return _Timer(histogram, self._lock)
+
+    def render(self):
+        """Returns all metrics in the Prometheus text exposition format."""
+        def fmt(labels, extra=()):
+            pairs = list(labels) + list(extra)
+            return '{' + ','.join(f'{k}="{v}"' for k, v in pairs) + '}' if pairs else ''
+
+        lines = []
+        for (name, labels), value in sorted(self.counters.items()):
+            lines.append(f"{name}{fmt(labels)} {value}")
+        for (name, labels), value in sorted(self.gauges.items()):
+            lines.append(f"{name}{fmt(labels)} {value}")
+        with self._lock:
+            histograms = sorted((key, hist.copy()) for key, hist in self.histograms.items())
+        for (name, labels), hist in histograms:
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS + ('+Inf',), hist.counts):
+                cumulative += count
+                lines.append(f"{name}_bucket{fmt(labels, [('le', bound)])} {cumulative}")
+            lines.append(f"{name}_sum{fmt(labels)} {hist.sum}")
+            lines.append(f"{name}_count{fmt(labels)} {hist.count}")
+        return '\n'.join(lines)
+
+    def snapshot(self):
+        """Returns the current values as a JSON-serializable dict."""
+        with self._lock:
+            histograms = [(k, h.copy()) for k, h in self.histograms.items()]
+        def key(name, labels):
+            return name + (json.dumps(dict(labels), separators=(',', ':')) if labels else '')
+        return {
+            'time': time.time(),
+            'counters': {key(*k): v for k, v in self.counters.items()},
+            'gauges': {key(*k): v for k, v in self.gauges.items()},
+            'histograms': {key(*k): {'count': h.count, 'sum': h.sum, 'buckets': h.counts} for k, h in histograms},
+        }
+
+metrics = MetricsRegistry()
+
+async def collect_peer_rtts():
+    """Updates the kqsp_peer_rtt_seconds gauge for every connected peer."""
+    for peer_id, pc in list(app.mesh.peers.items()):
+        rtt = None
+        try:
+            stats = await pc.getStats() # Only carries RTT once media tracks are attached
+            rtt = next((s.roundTripTime for s in stats.values() if getattr(s, 'type', None) == 'remote-inbound-rtp'), None)
+        except Exception:
+            pass
+        if rtt is None and pc.sctp is not None:
+            rtt = getattr(pc.sctp, '_srtt', None) # SCTP's smoothed RTT covers data-only peers
+        if rtt is not None:
+            metrics.set_gauge('kqsp_peer_rtt_seconds', rtt, peer=peer_id)
+
+async def write_metrics_jsonl(path, interval=METRICS_SNAPSHOT_INTERVAL):
+    """Appends a metrics snapshot to `path` every `interval` seconds until cancelled."""
+    try:
+        while True:
+            await asyncio.sleep(interval)
+            await collect_peer_rtts()
+            with open(path, 'a') as f:
+                f.write(json.dumps(metrics.snapshot()) + '\n')
+    except asyncio.CancelledError:
+        with open(path, 'a') as f: # Final snapshot on shutdown
+            f.write(json.dumps(metrics.snapshot()) + '\n')
+        raise
 
 # --- Group Key & Encryption (Same as before) ---
+# The group key is SHA-256 over the JSON list of sorted member peer IDs, the
+# same derivation as the web client's updateGroupKey(). GroupKeyManager keeps
+# the membership sorted as peers come and go, caches keys per membership so
+# churn back to a known group costs nothing, and only notifies subscribers
+# when the key actually changes.
+GROUP_KEY_CACHE_SIZE = 64
+KEYSTREAM_TILE_SIZE = 64 * 1024 # Precomputed keystream covers a file chunk and then some
+
+class GroupKeyManager:
+    """Incrementally maintained group membership and its derived key."""
+    def __init__(self, my_peer_id):
+        self._my_peer_id = my_peer_id
+        self._members = [my_peer_id] # Kept sorted
+        self._cache = collections.OrderedDict() # tuple(members) -> key, LRU
+        self._subscribers = []
+        self.version = 0 # Bumped on every membership change
+        self.key = None  # Not established until membership is first set
+
+    @property
+    def members(self):
+        return tuple(self._members)
+
+    def subscribe(self, callback):
+        """Calls callback(key) whenever the derived key changes."""
+        self._subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        """Stops calling a callback passed to subscribe()."""
+        self._subscribers.remove(callback)
+
+    def add(self, peer_id):
+        index = bisect.bisect_left(self._members, peer_id)
+        if index < len(self._members) and self._members[index] == peer_id:
+            if self.key is None:
+                self._rederive()
+            return
+        self._members.insert(index, peer_id)
+        self._rederive()
+
+    def discard(self, peer_id):
+        if peer_id == self._my_peer_id:
+            return
+        index = bisect.bisect_left(self._members, peer_id)
+        if index < len(self._members) and self._members[index] == peer_id:
+            del self._members[index]
+            self._rederive()
+        elif self.key is None:
+            self._rederive()
+
+    def set_members(self, peer_ids):
+        members = sorted({self._my_peer_id, *peer_ids})
+        if members == self._members and self.key is not None:
+            return
+        self._members = members
+        self._rederive()
+
+    def _rederive(self):
+        self.version += 1
+        members = tuple(self._members)
+        key = self._cache.get(members)
+        if key is None:
+            # Compact separators to match JSON.stringify() byte for byte
+            key = hashlib.sha256(json.dumps(members, separators=(',', ':')).encode('utf-8')).digest()
+            self._cache[members] = key
+            if len(self._cache) > GROUP_KEY_CACHE_SIZE:
+                self._cache.popitem(last=False)
+        else:
+            self._cache.move_to_end(members)
+        if key == self.key:
+            return
+        self.key = key
+        prime_keystream(key)
+        for callback in self._subscribers:
+            callback(key)
+
+def _on_group_key_change(key):
+    global group_key
+    group_key = key
+    # print(f"[Debug] Group key updated based on: {group_keys.members}")
+
+def _on_relay_key_change(key):
+    global relay_key
+    relay_key = key
+
+# group_keys covers our direct connections, exactly like the web client, and
+# encrypts JSON frames. relay_keys also covers members relay nodes announced
+# and encrypts binary frames, which only CLI peers read (see Relay). With no
+# relay nodes around both hold the same members and the same key.
+group_keys = GroupKeyManager(MY_PEER_ID)
+group_keys.subscribe(_on_group_key_change)
+relay_keys = GroupKeyManager(MY_PEER_ID)
+relay_keys.subscribe(_on_relay_key_change)
+
 def update_group_key(connected_peer_ids):
     """Updates the group key based on connected peers."""
-    global group_key
-    peer_ids = sorted([MY_PEER_ID] + list(connected_peer_ids))
-    hasher = hashlib.sha256()
-    hasher.update(json.dumps(peer_ids).encode('utf-8'))
-    group_key = hasher.digest()
-    # print(f"[Debug] Group key updated based on: {peer_ids}")
+    group_keys.set_members(connected_peer_ids)
 
-def xor_crypt(data_bytes, key_bytes):
-    """Encrypts/decrypts data using XOR with the key."""
+# XOR is done over whole buffers: the key is tiled once into a keystream of the
+# payload's length and combined in a single vectorized pass (NumPy when
+# available, otherwise one big-int XOR). Byte-for-byte this is identical to the
+# browser's `enc.map((b, i) => b ^ groupKey[i % groupKey.length])`.
+np = None # Set by load_numpy(); until then the pure-Python path is used
+
+def load_numpy():
+    """Imports NumPy for the XOR fast path if it's installed. Returns the module or None."""
+    global np
+    if np is None:
+        try:
+            import numpy
+        except ImportError: # NumPy is optional, fall back to pure Python
+            return None
+        np = numpy
+    return np
+
+KEYSTREAM_TILED_KEYS = 2 # The group key and the relay key
+_tiled_keys = {} # key -> key repeated to KEYSTREAM_TILE_SIZE + len(key), newest last
+
+def prime_keystream(key_bytes):
+    """Precomputes the tiled keystream for `key_bytes` so per-message calls just slice it."""
+    global _tiled_keys
+    key_bytes = bytes(key_bytes)
+    reps = -(-KEYSTREAM_TILE_SIZE // len(key_bytes)) + 1
+    tiled_keys = {k: v for k, v in _tiled_keys.items() if k != key_bytes}
+    tiled_keys[key_bytes] = key_bytes * reps
+    while len(tiled_keys) > KEYSTREAM_TILED_KEYS:
+        del tiled_keys[next(iter(tiled_keys))]
+    _tiled_keys = tiled_keys # Swapped whole, decode workers read it without a lock
+
+def keystream(key_bytes, length, offset=0):
+    """Returns `length` bytes of the repeating key, starting at stream position `offset`."""
+    key_len = len(key_bytes)
+    start = offset % key_len
+    tiled = _tiled_keys.get(key_bytes) if isinstance(key_bytes, bytes) else None
+    if tiled is not None and start + length <= len(tiled):
+        return tiled[start:start + length]
+    reps = -(-(start + length) // key_len) # ceil division
+    return (bytes(key_bytes) * reps)[start:start + length]
+
+def xor_crypt_into(buffer, key_bytes, offset=0):
+    """XORs a writable buffer (bytearray / memoryview) with the key in place."""
+    if not key_bytes:
+        return buffer
+    view = memoryview(buffer).cast('B')
+    length = len(view)
+    if not length:
+        return buffer
+    stream = keystream(key_bytes, length, offset)
+    if np is not None:
+        arr = np.frombuffer(view, dtype=np.uint8)
+        np.bitwise_xor(arr, np.frombuffer(stream, dtype=np.uint8), out=arr)
+    else:
+        view[:] = (int.from_bytes(view, 'little') ^ int.from_bytes(stream, 'little')).to_bytes(length, 'little')
+    return buffer
+
+def xor_crypt(data_bytes, key_bytes, offset=0):
+    """Encrypts/decrypts data using XOR with the key.
+
+    `offset` is the position of `data_bytes` within the overall stream, so a
+    chunk can be processed on its own and still line up with the key.
+    """
     if not key_bytes:
         return data_bytes # No encryption if key is not set
-    key_len = len(key_bytes)
-    return bytes([b ^ key_bytes[i % key_len] for i, b in enumerate(data_bytes)])
+    if not data_bytes:
+        return b''
+    length = len(data_bytes)
+    stream = keystream(key_bytes, length, offset)
+    if np is not None:
+        return np.bitwise_xor(np.frombuffer(data_bytes, dtype=np.uint8), np.frombuffer(stream, dtype=np.uint8)).tobytes()
+    return (int.from_bytes(data_bytes, 'little') ^ int.from_bytes(stream, 'little')).to_bytes(length, 'little')
 
-# --- WebRTC Data Channel Handling ---
-async def handle_data_channel(channel, peer_id):
-    """Handles messages received on a data channel."""
-    await message_queue.put(f"[System] Data channel '{channel.label}' created with {peer_id}")
-    update_group_key({pc.remoteDescription.sdp.split('o=')[1].split(' ')[0] for pc in pcs if pc.remoteDescription}) # Update key on new channel
+# --- Compression ---
+# Payloads are optionally compressed before encryption. Each codec is a hello
+# capability; a peer only gets compressed frames in a codec it advertised, so
+# web clients (which never advertise one) keep receiving plain ciphertext.
+# zlib is always there, zstd and lz4 are used when their packages are installed.
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import lz4.frame as lz4_frame
+except ImportError:
+    lz4_frame = None
 
-    @channel.on("message")
-    async def on_message(message):
+CODEC_NONE = 0
+CODEC_ZLIB = 1
+CODEC_ZSTD = 2
+CODEC_LZ4 = 3
+CODEC_NAMES = {CODEC_ZLIB: 'zlib', CODEC_ZSTD: 'zstd', CODEC_LZ4: 'lz4'}
+# Our preference order, fastest first; only codecs that are importable
+CODECS = [codec for codec, available in ((CODEC_ZSTD, zstandard), (CODEC_LZ4, lz4_frame), (CODEC_ZLIB, zlib)) if available]
+COMPRESS_MIN_SIZE = 256       # Smaller payloads can't win back the codec framing
+COMPRESS_MAX_RATIO = 0.9      # Only ship compressed output at least 10% smaller
+MAX_DECOMPRESSED_SIZE = 16 * 1024 * 1024 # Refuse decompression bombs
+COMPRESS_GIVE_UP = 4          # Stop trying on a file after this many chunks in a row don't shrink
+# What each codec raises on corrupt input; lz4 uses RuntimeError, zstd its own ZstdError
+DECOMPRESS_ERRORS = (zlib.error, RuntimeError) + ((zstandard.ZstdError,) if zstandard is not None else ())
+# Leading bytes of formats that are already compressed (archives, media, images)
+COMPRESSED_MAGICS = (
+    b'\x1f\x8b', b'PK\x03\x04', b'\x28\xb5\x2f\xfd', b'\x04\x22\x4d\x18', b'BZh', b'\xfd7zXZ',
+    b'7z\xbc\xaf', b'Rar!', b'\x89PNG', b'\xff\xd8\xff', b'GIF8', b'OggS', b'fLaC', b'ID3', b'\x1aE\xdf\xa3',
+)
+
+def codec_caps():
+    """Capability names to advertise in our hello frame."""
+    return [CODEC_NAMES[codec] for codec in CODECS] if app.compression else []
+
+def pick_codec(caps):
+    """Best codec both we and a peer with hello capabilities `caps` support."""
+    if app.compression:
+        for codec in CODECS:
+            if CODEC_NAMES[codec] in caps:
+                return codec
+    return CODEC_NONE
+
+def looks_compressed(data):
+    """True if `data` starts like a format that is already compressed."""
+    head = bytes(data[:4])
+    return head.startswith(COMPRESSED_MAGICS)
+
+def compress_payload(codec, data):
+    """Compresses `data` with `codec`, or returns None if it isn't worth it."""
+    if codec == CODEC_NONE or len(data) < COMPRESS_MIN_SIZE:
+        return None
+    with metrics.timer('kqsp_compress_seconds'):
+        if codec == CODEC_ZSTD:
+            packed = zstandard.ZstdCompressor(level=3).compress(data)
+        elif codec == CODEC_LZ4:
+            packed = lz4_frame.compress(data)
+        else:
+            packed = zlib.compress(data, 1)
+    if len(packed) > len(data) * COMPRESS_MAX_RATIO:
+        metrics.inc('kqsp_compress_skipped_total')
+        return None
+    metrics.inc('kqsp_compress_saved_bytes_total', len(data) - len(packed))
+    return packed
+
+def decompress_payload(codec, data):
+    """Reverses compress_payload. Raises ValueError on bad or oversized input.
+
+    Output is capped at MAX_DECOMPRESSED_SIZE while decompressing, whatever
+    size the frame claims, so a small payload can't inflate past it.
+    """
+    try:
+        if codec == CODEC_ZLIB:
+            inflater = zlib.decompressobj()
+            out = inflater.decompress(data, MAX_DECOMPRESSED_SIZE)
+            if inflater.unconsumed_tail:
+                raise ValueError("decompressed payload too large")
+            return out
+        if codec == CODEC_ZSTD and zstandard is not None:
+            # max_output_size only applies to frames that don't declare their size
+            declared = zstandard.get_frame_parameters(data).content_size
+            if declared != zstandard.CONTENTSIZE_UNKNOWN and declared > MAX_DECOMPRESSED_SIZE:
+                raise ValueError("decompressed payload too large")
+            return zstandard.ZstdDecompressor().decompress(data, max_output_size=MAX_DECOMPRESSED_SIZE)
+        if codec == CODEC_LZ4 and lz4_frame is not None:
+            inflater = lz4_frame.LZ4FrameDecompressor()
+            out = inflater.decompress(data, max_length=MAX_DECOMPRESSED_SIZE)
+            if not inflater.eof:
+                raise ValueError("decompressed payload too large or truncated")
+            return out
+    except DECOMPRESS_ERRORS as e:
+        raise ValueError(f"cannot decompress payload: {e}") from e
+    raise ValueError(f"unsupported codec {codec}")
+
+# --- Wire Format ---
+# Besides the JSON envelope the web client speaks, CLI peers exchange compact
+# binary frames: a fixed header followed by the raw ciphertext, sent as a
+# binary data-channel message. Peers advertise the formats they understand in
+# a 'hello' frame when the chat channel opens; anyone that never says hello
+# (older web clients) keeps getting JSON.
+WIRE_BINARY = 'binary-v1'
+FRAME_MAGIC = b'KQ'
+FRAME_VERSION = 1
+FRAME_TEXT = 1
+FRAME_FILE_CHUNK = 2
+FRAME_RELAY = 3 # Another frame, forwarded by a relay node (see Relay)
+# The high nibble of the type byte holds the payload codec (see Compression)
+FRAME_TYPE_MASK = 0x0F
+FRAME_CODEC_SHIFT = 4
+# magic, version, type, sender K(addr) as 4 raw bytes, sequence, payload length
+FRAME_HEADER = struct.Struct('!2sBB4sII')
+# Prefix of a FRAME_FILE_CHUNK payload: transfer id, file offset
+FILE_CHUNK_HEADER = struct.Struct('!8sQ')
+
+MY_ADDR_BYTES = bytes(int(part) for part in MY_DISPLAY_ADDR.split('.'))
+frame_seq = itertools.count(1)
+
+def next_seq():
+    return next(frame_seq) & 0xFFFFFFFF
+
+def encode_frame(frame_type, seq, *parts):
+    """Packs a binary frame around `parts` (bytes-like), concatenated as the payload."""
+    length = sum(len(part) for part in parts)
+    frame = bytearray(FRAME_HEADER.size + length)
+    FRAME_HEADER.pack_into(frame, 0, FRAME_MAGIC, FRAME_VERSION, frame_type, MY_ADDR_BYTES, seq, length)
+    pos = FRAME_HEADER.size
+    for part in parts:
+        frame[pos:pos + len(part)] = part
+        pos += len(part)
+    return bytes(frame)
+
+def decode_frame(message):
+    """Splits a binary frame into (type, sender, seq, payload) without copying the payload."""
+    view = memoryview(message)
+    if len(view) < FRAME_HEADER.size:
+        raise ValueError("truncated frame header")
+    magic, version, frame_type, sender, seq, length = FRAME_HEADER.unpack_from(view)
+    if magic != FRAME_MAGIC or version != FRAME_VERSION:
+        raise ValueError(f"unsupported frame (magic {magic!r}, version {version})")
+    payload = view[FRAME_HEADER.size:FRAME_HEADER.size + length]
+    if len(payload) != length:
+        raise ValueError("truncated frame payload")
+    return frame_type, f"K({'.'.join(map(str, sender))})", seq, payload
+
+# --- Send Scheduling / Backpressure ---
+# aiortc queues outbound data in its SCTP transport without limit. Bulk frames
+# (file chunks, audio) go through a per-channel queue that only feeds the
+# channel while its bufferedAmount is under SEND_HIGH_WATER and resumes on the
+# 'bufferedamountlow' event. Interactive frames skip that queue, so a chat line
+# only ever waits behind at most SEND_HIGH_WATER bytes of bulk data.
+#
+# A bulk send returns once the frame is in that queue, which holds up to
+# SEND_WINDOW frames per peer. A broadcast to a slow peer therefore only waits
+# when that peer is a full window behind, and a peer that takes no frame for
+# SEND_STALL_TIMEOUT is failed instead of stalling everyone else.
+SEND_HIGH_WATER = 256 * 1024
+SEND_LOW_WATER = 64 * 1024
+SEND_WINDOW = 64 # Bulk frames queued per channel, 1 MiB of file chunks
+SEND_STALL_TIMEOUT = 30.0 # Seconds a full window may go without draining
+
+class ChannelSender:
+    """Backpressure-aware send scheduler for one data channel."""
+    def __init__(self, channel):
+        self.channel = channel
+        self._bulk = collections.deque() # Frames waiting for buffer room
+        self._error = None # Why the channel stopped taking frames, raised to later senders
+        self._wakeup = asyncio.Event()
+        self._room = asyncio.Event() # Set while the bulk queue is under SEND_WINDOW
+        self._room.set()
+        self._idle = asyncio.Event() # Set while the bulk queue is empty
+        self._idle.set()
+        self._drained = asyncio.Event()
+        self._drained.set()
+        channel.bufferedAmountLowThreshold = SEND_LOW_WATER
+        channel.on("bufferedamountlow", self._drained.set)
+        self._task = asyncio.create_task(self._pump())
+
+    def _check(self):
+        if self._error is not None:
+            raise self._error
+        if self.channel.readyState != 'open':
+            raise ConnectionError(f"channel '{self.channel.label}' is {self.channel.readyState}")
+
+    async def send(self, data, bulk=False):
+        """Sends `data`, or queues it if it is a bulk frame.
+
+        Bulk sends wait only while this channel's window is full, and raise
+        TimeoutError if it doesn't drain within SEND_STALL_TIMEOUT. An earlier
+        queued frame that failed to send fails the next call.
+        """
+        self._check()
+        metrics.inc('kqsp_frames_sent_total', kind='bulk' if bulk else 'interactive')
+        metrics.inc('kqsp_bytes_sent_total', len(data))
+        if not bulk:
+            with metrics.timer('kqsp_channel_send_seconds', kind='interactive'):
+                self.channel.send(data)
+            return
+        with metrics.timer('kqsp_channel_send_seconds', kind='bulk'): # Time spent waiting for window room
+            while len(self._bulk) >= SEND_WINDOW:
+                self._room.clear()
+                try:
+                    await asyncio.wait_for(self._room.wait(), SEND_STALL_TIMEOUT)
+                except asyncio.TimeoutError:
+                    raise TimeoutError(f"channel '{self.channel.label}' took no data for {SEND_STALL_TIMEOUT:.0f}s") from None
+                self._check()
+        self._bulk.append(data)
+        self._idle.clear()
+        self._wakeup.set()
+
+    async def flush(self):
+        """Waits until every queued bulk frame has been handed to the channel."""
+        await self._idle.wait()
+        self._check()
+
+    async def _pump(self):
+        while True:
+            if not self._bulk:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            if self.channel.bufferedAmount > SEND_HIGH_WATER:
+                self._drained.clear()
+                await self._drained.wait()
+                continue
+            data = self._bulk.popleft()
+            try:
+                self.channel.send(data)
+            except Exception as e:
+                self._fail(e)
+                return
+            if len(self._bulk) < SEND_WINDOW:
+                self._room.set()
+            if not self._bulk:
+                self._idle.set()
+
+    def _fail(self, error):
+        self._error = self._error or error
+        self._bulk.clear()
+        self._room.set() # Wake waiting senders so they see the error
+        self._idle.set()
+
+    def close(self):
+        self._task.cancel()
+        self._fail(ConnectionError(f"channel '{self.channel.label}' closed"))
+
+def get_sender(channel):
+    """Returns the send scheduler for a channel, creating it on first use."""
+    sender = app.channel_senders.get(channel)
+    if sender is None:
+        sender = app.channel_senders[channel] = ChannelSender(channel)
+    return sender
+
+async def broadcast(frame, channels=None, bulk=False, flush=False):
+    """Sends one already encrypted and serialized frame to many peers at once.
+
+    `frame` (str or bytes, both immutable) is built exactly once by the caller
+    and the same object goes to every channel, so CPU cost does not grow with
+    the mesh. Sends run concurrently; a failing peer never stops the others.
+    Bulk frames are queued per peer (see SEND_WINDOW), so this only waits on
+    a peer that is a whole window behind. With `flush`, it also waits until
+    each peer's queue has been handed to its channel.
+    `channels` maps peer_id -> channel and defaults to every open chat channel.
+    Returns {peer_id: None on success or the exception raised for that peer}.
+    """
+    if channels is None:
+        channels = dict(app.mesh.chat_channels)
+    peer_ids = list(channels)
+
+    async def send(channel):
+        sender = get_sender(channel)
+        await sender.send(frame, bulk=bulk)
+        if flush:
+            await sender.flush()
+
+    results = await asyncio.gather(*(send(channels[p]) for p in peer_ids), return_exceptions=True)
+    return dict(zip(peer_ids, results))
+
+async def broadcast_formats(make_binary, make_json, channels=None, bulk=False):
+    """Broadcasts using each peer's negotiated wire format.
+
+    `make_binary(codec)` builds the binary frame for peers that negotiated
+    `codec` (CODEC_NONE for uncompressed). Each format/codec pair is framed at
+    most once, and only if some peer needs it.
+    """
+    if channels is None:
+        channels = dict(app.mesh.chat_channels)
+    by_codec = {}
+    legacy = {}
+    for peer_id, channel in channels.items():
+        caps = app.mesh.capabilities.get(peer_id, ())
+        if WIRE_BINARY in caps:
+            by_codec.setdefault(pick_codec(caps), {})[peer_id] = channel
+        else:
+            legacy[peer_id] = channel
+    sends = []
+    for codec, binary in by_codec.items():
+        sends.append(broadcast(make_binary(codec), binary, bulk))
+    if legacy:
+        sends.append(broadcast(make_json(), legacy, bulk))
+    results = {}
+    for result in await asyncio.gather(*sends):
+        results.update(result)
+    return results
+
+# --- File Transfer (chunked / streaming) ---
+# Files are sent as a FILE_START header, a run of FILE_CHUNK frames and a
+# FILE_END trailer carrying the SHA-256 of the plaintext. Transfers from
+# RELAY_CAP peers are keyed by the origin's K(addr) (see Relay), others by
+# peer ID. Each chunk is XORed
+# with the keystream at its own file offset, so any chunk decrypts on its own
+# and neither side ever holds more than one chunk in memory. A receiver that
+# has to abort a transfer sends the sender one 'file-cancel' and drops
+# whatever chunks are still on the way.
+#
+# When a sender disconnects mid-transfer, the .part is only kept if the sender
+# keeps a message log (LOG_NODE_CAP) and may resume it, for up to
+# INCOMING_RESUME_TTL and at most INCOMING_RESUME_MAX at a time. Anything else
+# that stops receiving chunks is dropped after INCOMING_IDLE_TIMEOUT.
+FILE_CHUNK_SIZE = 16 * 1024 # Stays well under SCTP message size limits
+DOWNLOAD_DIR = os.path.join(os.getcwd(), "kqsp_downloads")
+TRANSFER_ID = re.compile(r'[0-9a-f]{16}') # os.urandom(8).hex(), names the .part file
+INCOMING_IDLE_TIMEOUT = 300.0 # Seconds without a chunk before a transfer is dropped
+INCOMING_RESUME_TTL = 3600.0  # Seconds an interrupted transfer waits for its sender to resume it
+INCOMING_RESUME_MAX = 8       # Interrupted transfers kept for resume at once, oldest dropped first
+INCOMING_REAP_INTERVAL = 60.0 # Seconds between sweeps for idle transfers
+
+def claim_download_path(filename):
+    """Reserves a DOWNLOAD_DIR path for `filename` without clobbering earlier downloads.
+
+    The first free name of `name.ext`, `name (1).ext`, ... is created empty
+    and returned, so the caller can os.replace() its data over it.
+    """
+    os.makedirs(DOWNLOAD_DIR, exist_ok=True)
+    # Never trust a remote path, keep only the final component
+    filename = os.path.basename(filename) or "unnamed"
+    stem, extension = os.path.splitext(filename)
+    for n in itertools.count():
+        path = os.path.join(DOWNLOAD_DIR, f"{stem} ({n}){extension}" if n else filename)
         try:
-            # Assume message is JSON payload as string
-            payload = json.loads(message)
-            if payload.get('type') == 'text':
-                encrypted_text_bytes = payload['text'].encode('latin-1')
-                decrypted_bytes = xor_crypt(encrypted_text_bytes, group_key)
-                await message_queue.put(f"{payload['from']}: {decrypted_bytes.decode('utf-8')}")
-            # Add handlers for 'file', 'audio' later
+            open(path, 'x').close()
+            return path
+        except FileExistsError:
+            continue
+
+class IncomingFile:
+    """Receives a chunked file straight to disk, verifying it on completion."""
+    def __init__(self, transfer_id, filename, size, sender):
+        os.makedirs(DOWNLOAD_DIR, exist_ok=True)
+        self.filename = os.path.basename(filename) or "unnamed"
+        self.size = size
+        self.sender = sender
+        self.path = None # Claimed once the file checks out
+        # Named by transfer so concurrent transfers of the same filename never share it
+        self.part_path = os.path.join(DOWNLOAD_DIR, f".{transfer_id}.part")
+        self._file = open(self.part_path, 'wb')
+        self._hasher = hashlib.sha256()
+        self.received = 0
+        self.touched = time.monotonic() # Last sign of life from the sender
+        self.interrupted = False        # Sender went away, held in case it resumes
+
+    def write_chunk(self, offset, chunk):
+        """Appends an already decrypted chunk."""
+        self.touched = time.monotonic()
+        if offset != self.received:
+            raise ValueError(f"out-of-order chunk at {offset}, expected {self.received}")
+        if self.received + len(chunk) > self.size:
+            raise ValueError(f"more data than the {self.size} bytes announced")
+        self._file.write(chunk)
+        self._hasher.update(chunk)
+        self.received += len(chunk)
+
+    def finish(self, expected_sha256):
+        self._file.close()
+        if self._hasher.hexdigest() != expected_sha256:
+            os.remove(self.part_path)
+            return False
+        self.path = claim_download_path(self.filename)
+        os.replace(self.part_path, self.path)
+        return True
+
+    def abort(self):
+        self._file.close()
+        if os.path.exists(self.part_path):
+            os.remove(self.part_path)
+
+async def handle_file_message(payload, peer_id):
+    """Handles FILE_START / FILE_CHUNK / FILE_END frames from a peer."""
+    msg_type = payload['type']
+    if not isinstance(payload['id'], str) or not TRANSFER_ID.fullmatch(payload['id']):
+        await app.messages.put(f"[System] Ignoring {msg_type} from {peer_id} with malformed transfer id.")
+        return
+    key = (peer_id, payload['id'])
+    if msg_type == 'file-start':
+        if not isinstance(payload['size'], int) or payload['size'] < 0 or not isinstance(payload['filename'], str):
+            await app.messages.put(f"[System] Ignoring file-start from {peer_id} with malformed size or filename.")
+            return
+        incoming = app.incoming_files.get(key)
+        if payload.get('resume') and incoming is None:
+            # Transfer IDs are random, so a sender that restarted under a new peer ID still matches
+            old_key = next((k for k in app.incoming_files if k[1] == payload['id']), None)
+            if old_key is not None:
+                incoming = app.incoming_files[key] = app.incoming_files.pop(old_key)
+        if payload.get('resume') and incoming is not None: # Interrupted earlier, pick up where it stopped
+            incoming.interrupted, incoming.touched = False, time.monotonic()
+            await app.messages.put(f"[System] Resuming '{incoming.filename}' from {payload['from']} at {incoming.received} bytes...")
+        else:
+            if incoming is not None:
+                incoming.abort()
+            incoming = app.incoming_files[key] = IncomingFile(payload['id'], payload['filename'], payload['size'], payload['from'])
+            await app.messages.put(f"[System] Receiving '{payload['filename']}' ({payload['size']} bytes) from {payload['from']}...")
+        if payload.get('resume'):
+            send_file_ack(peer_id, payload['id'], incoming.received)
+    elif msg_type == 'file-end':
+        incoming = app.incoming_files.pop(key, None)
+        if incoming is None: # Aborted earlier, the sender has been told
+            return
+        if incoming.finish(payload['sha256']):
+            send_file_ack(peer_id, payload['id'], incoming.received, done=True)
+            await app.messages.put(f"[System] Received '{incoming.filename}' from {incoming.sender}, saved to {incoming.path}")
+        else:
+            await app.messages.put(f"[System] Integrity check failed for '{incoming.filename}' from {incoming.sender}, discarded.")
+
+def interrupt_incoming_files(senders, resumable):
+    """Deals with the transfers from `senders` (peer ID / K(addr)) when they disconnect.
+
+    They are kept for a resume only if `resumable`; nothing else could ever
+    finish them.
+    """
+    for key in [k for k in app.incoming_files if k[0] in senders]:
+        incoming = app.incoming_files[key]
+        if resumable:
+            incoming.interrupted, incoming.touched = True, time.monotonic()
+        else:
+            app.incoming_files.pop(key).abort()
+            app.messages.put_nowait(f"[System] Transfer of '{incoming.filename}' from {incoming.sender} lost, the sender disconnected.")
+    reap_incoming_files()
+
+def reap_incoming_files():
+    """Drops transfers that went quiet and interrupted ones past INCOMING_RESUME_TTL/MAX."""
+    now = time.monotonic()
+    expired = [k for k, f in app.incoming_files.items()
+               if now - f.touched > (INCOMING_RESUME_TTL if f.interrupted else INCOMING_IDLE_TIMEOUT)]
+    held = sorted((k for k, f in app.incoming_files.items() if f.interrupted and k not in expired),
+                  key=lambda k: app.incoming_files[k].touched)
+    for key in expired + held[:-INCOMING_RESUME_MAX]:
+        incoming = app.incoming_files.pop(key)
+        incoming.abort()
+        app.messages.put_nowait(f"[System] Gave up on '{incoming.filename}' from {incoming.sender} after it stalled.")
+
+def send_file_ack(peer_id, transfer_id, offset, done=False):
+    """Tells a peer keeping a message log how much of a transfer we hold.
+
+    `peer_id` may be the origin K(addr) relayed transfers are keyed by; only
+    an origin we are directly connected to can be acked.
+    """
+    peer_id = app.mesh.origins.get(peer_id, peer_id)
+    channel = app.mesh.chat_channels.get(peer_id)
+    if channel is not None and LOG_NODE_CAP in app.mesh.capabilities.get(peer_id, ()):
+        channel.send(json.dumps({'type': 'file-ack', 'id': transfer_id, 'offset': offset, 'done': done}))
+
+def send_file_cancel(peer_id, transfer_id, reason):
+    """Asks the sender of a transfer we aborted to stop streaming it to us."""
+    peer_id = app.mesh.origins.get(peer_id, peer_id)
+    channel = app.mesh.chat_channels.get(peer_id)
+    if channel is not None and WIRE_BINARY in app.mesh.capabilities.get(peer_id, ()):
+        channel.send(json.dumps({'type': 'file-cancel', 'id': transfer_id, 'reason': reason}))
+
+async def handle_file_cancel(payload, peer_id):
+    """Stops sending a transfer to a peer that aborted it."""
+    targets = app.outgoing_files.get(payload.get('id'))
+    if targets is not None and targets.pop(peer_id, None) is not None:
+        await app.messages.put(f"[System] Stopped sending to {peer_id}, it aborted the transfer: {payload.get('reason')}")
+
+def decrypt_file_chunk(encrypted_bytes, key_bytes, offset, codec=CODEC_NONE):
+    """Decrypts (and decompresses) one chunk. Touches nothing shared but metrics, so it can run on a worker thread."""
+    chunk = bytearray(encrypted_bytes)
+    with metrics.timer('kqsp_decrypt_seconds'):
+        xor_crypt_into(chunk, key_bytes, offset)
+    if codec != CODEC_NONE:
+        chunk = decompress_payload(codec, chunk)
+    return chunk
+
+async def receive_file_chunk(peer_id, transfer_id, offset, chunk, error=None):
+    """Appends one decrypted chunk of an incoming transfer to disk.
+
+    `error` is the exception decrypt_file_chunk raised, if it failed; the
+    transfer is aborted either way a chunk can't be used, and later chunks
+    for it are dropped.
+    """
+    key = (peer_id, transfer_id)
+    incoming = app.incoming_files.get(key)
+    if incoming is None: # Aborted already, the rest of the stream is still arriving
+        return
+    try:
+        if error is not None:
+            raise error
+        incoming.write_chunk(offset, chunk)
+    except (OSError, ValueError) as e:
+        app.incoming_files.pop(key).abort()
+        send_file_cancel(peer_id, transfer_id, str(e))
+        await app.messages.put(f"[System] Transfer of '{incoming.filename}' from {incoming.sender} failed: {e}")
+
+async def send_cli_file(path, progress=None, targets=None, transfer_id=None, offset=0):
+    """Streams a file from disk to all connected peers in encrypted chunks.
+
+    `progress`, if given, is awaited as progress(bytes_sent, size) after each
+    chunk. Returns True once the whole file has been sent. The message log
+    resumes a transfer by passing its `targets`, `transfer_id` and the
+    `offset` to continue from; the file-start frame is then left to it.
+    """
+    resuming = transfer_id is not None
+    if targets is None:
+        targets = app.mesh.open_channels()
+        # Web peers only take a whole file in one 'file' frame, never the chunked stream
+        web_peers = [peer_id for peer_id in targets if WIRE_BINARY not in app.mesh.capabilities.get(peer_id, ())]
+        for peer_id in web_peers:
+            del targets[peer_id]
+        if web_peers:
+            await app.messages.put(f"[System] Not sending '{os.path.basename(path)}' to web peer(s) {', '.join(web_peers)}: "
+                                   "they can't receive streamed files.")
+        if app.message_log is not None:
+            for peer_id in app.message_log.replaying: # Gets this file in order once caught up
+                targets.pop(peer_id, None)
+    if not targets and not (app.message_log is not None and not resuming):
+        await app.messages.put("[System] No active connections to send file.")
+        return False
+    if not group_key and targets:
+        await app.messages.put("[System] Group key not yet established. Cannot send file.")
+        return False
+    try:
+        size = os.path.getsize(path)
+        f = open(path, 'rb')
+    except OSError as e:
+        await app.messages.put(f"[System] Cannot read file {path}: {e}")
+        return False
+
+    transfer_id = transfer_id or os.urandom(8).hex()
+    filename = os.path.basename(path)
+    sender = f"K({MY_DISPLAY_ADDR})"
+    hasher = hashlib.sha256()
+    record_seq = None
+    if app.message_log is not None and not resuming:
+        record_seq = app.message_log.append(RECORD_FILE, json.dumps({
+            'path': os.path.abspath(path), 'id': transfer_id, 'filename': filename, 'size': size}).encode('utf-8'))
+        if not targets:
+            f.close()
+            await app.messages.put(f"[System] No active connections, '{filename}' will be sent when peers return.")
+            return False
+
+    async def check_results(results):
+        for peer_id, result in results.items():
+            if result is not None:
+                del targets[peer_id]
+                await app.messages.put(f"[System] Stopped sending '{filename}' to {peer_id}: {result}")
+        if not targets:
+            raise ConnectionError("no peers left to receive the file")
+
+    async def send_frame(payload, flush=False):
+        payload['seq'] = next_seq() # Lets relays tell this send apart from a re-send (see Relay)
+        await check_results(await broadcast(json.dumps(payload), targets, bulk=True, flush=flush))
+
+    compressible = True
+    misses = 0 # Consecutive chunks that didn't compress
+
+    async def send_chunk(offset, plaintext):
+        encrypted = {} # (codec actually used, key) -> ciphertext, so each is encrypted once
+
+        def encrypt(codec, data, key_bytes):
+            if (codec, key_bytes) not in encrypted:
+                buffer = bytearray(data)
+                with metrics.timer('kqsp_encrypt_seconds'):
+                    xor_crypt_into(buffer, key_bytes, offset)
+                encrypted[codec, key_bytes] = buffer
+            return encrypted[codec, key_bytes]
+
+        def make_binary(codec):
+            nonlocal compressible, misses
+            packed = None
+            if codec != CODEC_NONE and compressible:
+                packed = compress_payload(codec, plaintext)
+                misses = 0 if packed is not None else misses + 1
+                compressible = misses < COMPRESS_GIVE_UP
+            if packed is None:
+                codec = CODEC_NONE
+            return encode_frame(FRAME_FILE_CHUNK | codec << FRAME_CODEC_SHIFT, next_seq(),
+                                FILE_CHUNK_HEADER.pack(bytes.fromhex(transfer_id), offset),
+                                encrypt(codec, packed if packed is not None else plaintext, relay_key))
+
+        def make_json():
+            ciphertext = encrypt(CODEC_NONE, plaintext, group_key)
+            return json.dumps({'type': 'file-chunk', 'id': transfer_id, 'offset': offset, 'data': base64.b64encode(ciphertext).decode('ascii')})
+
+        await check_results(await broadcast_formats(make_binary, make_json, targets, bulk=True))
+
+    await app.messages.put(f"[System] Sending '{filename}' ({size - offset} bytes)...")
+    app.outgoing_files[transfer_id] = targets # handle_file_cancel drops peers from it
+    try:
+        with f:
+            if resuming: # The receiver already has everything before `offset`, just hash it
+                remaining = offset
+                while remaining:
+                    block = f.read(min(FILE_CHUNK_SIZE, remaining))
+                    if not block:
+                        break
+                    hasher.update(block)
+                    remaining -= len(block)
             else:
-                await message_queue.put(f"[System] Received unknown message type from {peer_id}: {payload.get('type')}")
-        except (json.JSONDecodeError, UnicodeDecodeError, KeyError, AttributeError) as e:
-            await message_queue.put(f"[System] Error processing message from {peer_id} on channel {channel.label}: {e}")
-            # Log raw message for debugging if not JSON
-            if isinstance(message, str):
-                 await message_queue.put(f"[System] Raw data: {message[:100]}...")
+                await send_frame({'type': 'file-start', 'from': sender, 'id': transfer_id, 'filename': filename, 'size': size})
+            chunk = bytearray(FILE_CHUNK_SIZE)
+            while True:
+                n = f.readinto(chunk)
+                if not n:
+                    break
+                view = memoryview(chunk)[:n]
+                hasher.update(view)
+                if offset == 0 and looks_compressed(view):
+                    compressible = False # Archives and media won't shrink, don't try
+                # Paused here only while some peer is a full SEND_WINDOW behind
+                await send_chunk(offset, view)
+                offset += n
+                if progress:
+                    await progress(offset, size)
+            # Only report the file as sent once each peer has taken all of it
+            await send_frame({'type': 'file-end', 'from': sender, 'id': transfer_id, 'sha256': hasher.hexdigest()}, flush=True)
+    except ConnectionError as e:
+        await app.messages.put(f"[System] Transfer of '{filename}' aborted: {e}")
+        return False
+    finally:
+        app.outgoing_files.pop(transfer_id, None)
+    if record_seq is not None:
+        for peer_id in targets:
+            app.message_log.sent(peer_id, record_seq, transfer_id=transfer_id)
+    await app.messages.put(f"[System] Sent '{filename}' ({offset} bytes).")
+    return True
+
+# --- Audio ---
+# Voice messages from the web client arrive as {type: 'audio', from, mimeType,
+# data} holding a MediaRecorder blob (base64, or a byte array from JSON
+# serialization). The blob is decoded slice by slice straight into a file in
+# its own container, never held decoded in memory as a whole.
+#
+# With --live-audio, every connection also carries a real audio track instead:
+# /talk toggles push-to-talk on our outgoing track, and incoming tracks are
+# recorded to DOWNLOAD_DIR as Ogg/Opus while the peer is connected.
+AUDIO_DECODE_SLICE = 64 * 1024 # Base64 characters decoded per write, a multiple of 4
+AUDIO_EXTENSIONS = {
+    'audio/webm': 'webm', 'audio/ogg': 'ogg', 'audio/opus': 'opus', 'audio/mp4': 'm4a',
+    'audio/aac': 'aac', 'audio/mpeg': 'mp3', 'audio/wav': 'wav', 'audio/x-wav': 'wav',
+}
+LIVE_AUDIO_CONTAINER = 'ogg' # MediaRecorder picks Opus for Ogg
+
+def audio_path(prefix, mime_type):
+    """A fresh DOWNLOAD_DIR path whose extension matches `mime_type`'s container."""
+    base = (mime_type or '').split(';', 1)[0].strip().lower() # Drop ';codecs=opus'
+    extension = AUDIO_EXTENSIONS.get(base, 'bin')
+    name = f"{prefix}-{time.strftime('%Y%m%d-%H%M%S')}-{os.urandom(2).hex()}.{extension}"
+    return os.path.join(DOWNLOAD_DIR, name)
+
+def write_blob(path, data, key_bytes=None):
+    """Streams a web client blob (base64 text or a byte array) to `path`.
+
+    With `key_bytes`, each slice is XORed at its offset in the blob as it's
+    written. Blocking, so the receive pipeline runs it on a worker for large
+    blobs. Partial output is removed on failure.
+    """
+    part_path = path + '.part'
+    try:
+        with open(part_path, 'wb') as f:
+            if isinstance(data, str):
+                decode = base64.b64decode
+            elif isinstance(data, list):
+                decode = bytes
             else:
-                 await message_queue.put(f"[System] Received non-string data: {type(message)}")
+                raise ValueError(f"unsupported blob data of type {type(data).__name__}")
+            offset = 0
+            for start in range(0, len(data), AUDIO_DECODE_SLICE):
+                block = bytearray(decode(data[start:start + AUDIO_DECODE_SLICE]))
+                if key_bytes:
+                    xor_crypt_into(block, key_bytes, offset)
+                f.write(block)
+                offset += len(block)
+        os.replace(part_path, path)
+    except BaseException:
+        if os.path.exists(part_path):
+            os.remove(part_path)
+        raise
+    return path
 
-    @channel.on("close")
-    async def on_close():
-        await message_queue.put(f"[System] Data channel '{channel.label}' closed with {peer_id}")
-        # Find the peer connection associated with this channel to remove if needed
-        # This part is tricky as channel doesn't directly link back to pc easily
-        # We might need to manage connections differently
+def save_audio_message(data, mime_type):
+    """Streams an audio message's data to disk, returns the saved path."""
+    os.makedirs(DOWNLOAD_DIR, exist_ok=True)
+    return write_blob(audio_path('audio', mime_type), data)
+
+def save_web_file(data, filename, key_bytes):
+    """Decrypts a web client's whole-file frame to DOWNLOAD_DIR, returns the saved path."""
+    path = claim_download_path(filename)
+    try:
+        return write_blob(path, data, key_bytes)
+    except BaseException:
+        os.remove(path)
+        raise
+
+def push_to_talk_track(source):
+    """Wraps `source` in a track that relays it while talking and silence otherwise, keeping its timing."""
+    from aiortc import MediaStreamTrack
+
+    class PushToTalkTrack(MediaStreamTrack):
+        kind = 'audio'
+
+        def __init__(self):
+            super().__init__()
+            self.source = source
+            self.talking = False
+
+        async def recv(self):
+            frame = await self.source.recv()
+            if not self.talking:
+                for plane in frame.planes:
+                    plane.update(bytes(plane.buffer_size))
+            return frame
+
+        def stop(self):
+            super().stop()
+            self.source.stop()
+
+    return PushToTalkTrack()
+
+class LiveAudio:
+    """Push-to-talk audio over WebRTC media tracks, shared by every connection."""
+    def __init__(self, source=None, source_format=None):
+        from aiortc.contrib.media import MediaPlayer, MediaRelay # Needs PyAV, only load it when asked
+        from aiortc.mediastreams import AudioStreamTrack
+        # Audio files loop so the track never changes format mid-call
+        self._player = MediaPlayer(source, format=source_format, loop=os.path.isfile(source)) if source else None
+        self.track = push_to_talk_track(self._player.audio if self._player else AudioStreamTrack())
+        self._relay = MediaRelay()
+        self._recorders = {} # peer_id -> MediaRecorder for that peer's incoming track
+
+    @property
+    def talking(self):
+        return self.track.talking
+
+    def toggle(self):
+        self.track.talking = not self.track.talking
+        return self.track.talking
+
+    def attach(self, pc):
+        """Adds our outgoing track to `pc` (before the offer, or after applying one)."""
+        pc.addTrack(self._relay.subscribe(self.track))
+
+    async def record(self, peer_id, track):
+        """Records a peer's incoming audio track until it ends."""
+        from aiortc.contrib.media import MediaRecorder
+        await self.stop_recording(peer_id)
+        os.makedirs(DOWNLOAD_DIR, exist_ok=True)
+        path = audio_path(f"live-{peer_id}", f"audio/{LIVE_AUDIO_CONTAINER}")
+        recorder = MediaRecorder(path, format=LIVE_AUDIO_CONTAINER)
+        recorder.addTrack(track)
+        self._recorders[peer_id] = recorder
+        await recorder.start()
+        await app.messages.put(f"[Audio] Recording live audio from {peer_id} to {path}")
+
+        @track.on("ended")
+        async def on_ended():
+            if self._recorders.get(peer_id) is recorder:
+                await self.stop_recording(peer_id)
+
+    async def stop_recording(self, peer_id):
+        recorder = self._recorders.pop(peer_id, None)
+        if recorder is not None:
+            await recorder.stop()
+
+    async def close(self):
+        await asyncio.gather(*(self.stop_recording(p) for p in list(self._recorders)), return_exceptions=True)
+        self.track.stop()
 
 # --- WebSocket Signaling (Basic Example) ---
 # This is a placeholder/example. A robust implementation needs to handle
 # the specific message format of your chosen WebSocket signaling server (e.g., PeerJS server).
+# Reconnect delays grow exponentially with full jitter so a fleet of nodes
+# doesn't stampede the server after an outage. Peer connections stay up while
+# signaling is down; only new offers/answers wait for the socket to return.
+# aiortc doesn't trickle ICE: setLocalDescription finishes gathering and puts
+# every candidate in the SDP, so we only ever receive CANDIDATE frames (from
+# browsers) and never send them.
+RECONNECT_MIN_DELAY = 0.5
+RECONNECT_MAX_DELAY = 30.0
+
 class WebSocketSignaling: # <-- REMOVE INHERITANCE
     def __init__(self, ws_url, peer_id, peer_role='offer'): # Added peer_id and role
         self._ws_url = ws_url
         self._peer_id = peer_id
         self._peer_role = peer_role # 'offer' or 'answer'
         self._websocket = None
-        self._session = None
+        self._session = None # One pooled session, reused across reconnects
         self._target_peer_id = None # For direct messaging if needed
+        self._connected = asyncio.Event()
+        self._closing = False
+        self._run_task = None
+        self._offers_sent_at = {} # dst -> perf_counter() when our OFFER went out
 
     async def connect(self):
-        self._session = aiohttp.ClientSession()
         try:
-            self._websocket = await self._session.ws_connect(self._ws_url)
-            # Register with the server (example, depends on server protocol)
-            # PeerJS servers often require an OPEN message with the peer ID
-            await self._websocket.send_json({'type': 'OPEN', 'src': self._peer_id})
-            # Start listening for messages
-            asyncio.create_task(self._receive_loop())
-            await message_queue.put(f"[System] WebSocket connected to {self._ws_url} as {self._peer_id}")
+            await self._open()
         except Exception as e:
-            await message_queue.put(f"[System] WebSocket connection failed: {e}")
+            await app.messages.put(f"[System] WebSocket connection failed: {e}")
             if self._session:
                 await self._session.close()
             raise
+        await app.messages.put(f"[System] WebSocket connected to {self._ws_url} as {self._peer_id}")
+        # Listen for messages, reconnecting whenever the socket drops
+        self._run_task = asyncio.create_task(self._run())
+
+    async def _open(self):
+        import aiohttp
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession()
+        self._websocket = await self._session.ws_connect(self._ws_url, heartbeat=30)
+        # Register with the server (example, depends on server protocol)
+        # PeerJS servers often require an OPEN message with the peer ID
+        await self._websocket.send_json({'type': 'OPEN', 'src': self._peer_id})
+        self._connected.set()
+
+    async def _run(self):
+        import aiohttp
+        delay = RECONNECT_MIN_DELAY
+        while not self._closing:
+            await self._receive_loop()
+            self._connected.clear()
+            if not self._closing:
+                await app.messages.put("[System] Signaling connection lost, peer connections stay up.")
+            while not self._closing:
+                wait = random.uniform(0, delay)
+                await app.messages.put(f"[System] Reconnecting to signaling in {wait:.1f}s...")
+                await asyncio.sleep(wait)
+                try:
+                    await self._open()
+                except (aiohttp.ClientError, OSError, asyncio.TimeoutError) as e:
+                    await app.messages.put(f"[System] Signaling reconnect failed: {e}")
+                    delay = min(delay * 2, RECONNECT_MAX_DELAY)
+                    continue
+                await app.messages.put(f"[System] Signaling reconnected as {self._peer_id}")
+                delay = RECONNECT_MIN_DELAY
+                break
 
     async def close(self):
+        self._closing = True
+        self._connected.set() # Wake sends held for a reconnect so they fail instead of hanging
+        if self._run_task:
+            self._run_task.cancel()
         if self._websocket:
             await self._websocket.close()
         if self._session:
             await self._session.close()
-        await message_queue.put("[System] WebSocket closed.")
+        await app.messages.put("[System] WebSocket closed.")
 
     async def receive(self):
         # This is now handled by the _receive_loop pushing to the main queue or handling internally
-        # For simplicity, we'll let the main loop poll the message_queue for signaling messages
+        # For simplicity, we'll let the main loop poll the app.messages for signaling messages
         # A better approach would be a dedicated signaling queue or direct calls
         await asyncio.sleep(3600) # Block indefinitely, messages handled in loop
 
     async def _receive_loop(self):
+        """Handles signaling messages until the socket closes."""
+        import aiohttp
         try:
             async for msg in self._websocket:
                 if msg.type == aiohttp.WSMsgType.TEXT:
-                    data = json.loads(msg.data)
-                    await message_queue.put(f"[Signal] Received: {data}") # Log raw signal
-
-                    # Basic PeerJS-like message handling (adapt as needed)
-                    msg_type = data.get('type')
-                    src_peer = data.get('src')
-                    dst_peer = data.get('dst')
-
-                    if dst_peer != self._peer_id: # Ignore messages not for us
-                        continue
-
-                    if msg_type == 'OFFER':
-                        self._target_peer_id = src_peer # Store who sent the offer
-                        await pc.setRemoteDescription(RTCSessionDescription(sdp=data['payload']['sdp'], type=data['payload']['type']))
-                        # Create and send answer
-                        await pc.setLocalDescription(await pc.createAnswer())
-                        await self.send(pc.localDescription)
-                    elif msg_type == 'ANSWER':
-                        await pc.setRemoteDescription(RTCSessionDescription(sdp=data['payload']['sdp'], type=data['payload']['type']))
-                    elif msg_type == 'CANDIDATE':
-                        candidate_info = data['payload']['candidate']
-                        # aiortc needs candidate, sdpMid, sdpMLineIndex
-                        candidate = RTCIceCandidate(
-                            sdpMid=candidate_info.get('sdpMid'),
-                            sdpMLineIndex=candidate_info.get('sdpMLineIndex'),
-                            candidate=candidate_info.get('candidate')
-                        )
-                        await pc.addIceCandidate(candidate)
-                    elif msg_type == 'LEAVE': # PeerJS uses LEAVE
-                        await message_queue.put(f"[System] Peer {src_peer} left.")
-                        # Handle disconnection logic if needed
-                        if self._target_peer_id == src_peer:
-                             # Potentially close the connection
-                             pass
-                    elif msg_type == 'EXPIRE': # PeerJS uses EXPIRE
-                         await message_queue.put(f"[System] Peer {src_peer} expired.")
-                         # Handle disconnection logic
-
+                    try:
+                        await self._handle_message(json.loads(msg.data))
+                    except Exception as e: # One bad message must not take down signaling
+                        await app.messages.put(f"[System] Bad signaling message: {type(e).__name__}: {e}")
                 elif msg.type == aiohttp.WSMsgType.ERROR:
-                    await message_queue.put(f"[System] WebSocket connection error: {self._websocket.exception()}")
+                    await app.messages.put(f"[System] WebSocket connection error: {self._websocket.exception()}")
                     break
         except Exception as e:
-            await message_queue.put(f"[System] WebSocket receive loop error: {e}")
+            await app.messages.put(f"[System] WebSocket receive loop error: {e}")
         finally:
-             await message_queue.put("[System] WebSocket receive loop ended.")
-             # Signal main loop to exit or reconnect?
-             stop_event.set()
+             await app.messages.put("[System] WebSocket receive loop ended.")
+
+    async def _handle_message(self, data):
+        from aiortc import RTCSessionDescription
+        if app.log_signals: # Opt-in, at high rates the logging costs more than the work
+            await app.messages.put(f"[Signal] Received: {data}")
+
+        # Basic PeerJS-like message handling (adapt as needed)
+        msg_type = data.get('type')
+        src_peer = data.get('src')
+        dst_peer = data.get('dst')
+        metrics.inc('kqsp_signaling_messages_total', type=msg_type, direction='in')
+
+        if dst_peer != self._peer_id: # Ignore messages not for us
+            return
+
+        # Each remote peer gets its own RTCPeerConnection in the mesh, keyed by src
+        if msg_type == 'OFFER':
+            answer = await app.mesh.handle_offer(src_peer, RTCSessionDescription(sdp=data['payload']['sdp'], type='offer'))
+            if answer is None: # Lost the offer race, the peer answers ours instead
+                return
+            self._offers_sent_at.pop(src_peer, None)
+            await self.send(answer, dst=src_peer)
+        elif msg_type == 'ANSWER':
+            sent_at = self._offers_sent_at.pop(src_peer, None)
+            if sent_at is not None:
+                metrics.observe('kqsp_signaling_rtt_seconds', time.perf_counter() - sent_at)
+            await app.mesh.handle_answer(src_peer, RTCSessionDescription(sdp=data['payload']['sdp'], type='answer'))
+        elif msg_type == 'CANDIDATE':
+            await app.mesh.handle_candidate(src_peer, data['payload']['candidate'])
+        elif msg_type == 'LEAVE': # PeerJS uses LEAVE
+            await app.messages.put(f"[System] Peer {src_peer} left.")
+            await app.mesh.remove(src_peer)
+        elif msg_type == 'EXPIRE': # PeerJS uses EXPIRE
+             await app.messages.put(f"[System] Peer {src_peer} expired.")
+             await app.mesh.remove(src_peer)
+
+    async def _send_json(self, message):
+        await self._connected.wait() # Hold outgoing signals while reconnecting
+        if self._closing:
+            raise ConnectionError("signaling is closed")
+        await self._websocket.send_json(message)
+        metrics.inc('kqsp_signaling_messages_total', type=message['type'], direction='out')
+        if message['type'] == 'OFFER':
+            self._offers_sent_at[message['dst']] = time.perf_counter() # OFFER -> ANSWER round trip
 
-    async def send(self, obj):
+    async def send(self, obj, dst=None):
+        from aiortc import RTCIceCandidate, RTCSessionDescription
+        from aiortc.contrib.signaling import BYE
+        from aiortc.sdp import candidate_to_sdp
+        dst = dst or self._target_peer_id
         if isinstance(obj, RTCSessionDescription):
             # Send OFFER or ANSWER (PeerJS format)
-            payload = {'type': obj.type.upper(), 'sdp': obj.sdp}
-            # Need target peer ID - how do we get this? Assume stored from OFFER or arg
-            if not self._target_peer_id:
+            payload = {'type': obj.type, 'sdp': obj.sdp}
+            if not dst:
                  # If offering, need to specify target peer ID somehow (e.g., via command line)
-                 # This basic example assumes we are answering an offer or target is known
-                 await message_queue.put("[System] Cannot send OFFER/ANSWER: Target Peer ID not set.")
+                 await app.messages.put("[System] Cannot send OFFER/ANSWER: Target Peer ID not set.")
                  return
-            message = {'type': obj.type.upper(), 'payload': payload, 'dst': self._target_peer_id, 'src': self._peer_id}
-            await self._websocket.send_json(message)
-            await message_queue.put(f"[Signal] Sent {obj.type.upper()} to {self._target_peer_id}")
+            message = {'type': obj.type.upper(), 'payload': payload, 'dst': dst, 'src': self._peer_id}
+            await self._send_json(message)
+            await app.messages.put(f"[Signal] Sent {obj.type.upper()} to {dst}")
         elif isinstance(obj, RTCIceCandidate):
             # Send CANDIDATE (PeerJS format)
             if obj.sdpMid is None:
@@ -202,211 +1334,1341 @@ class WebSocketSignaling: # <-- REMOVE INHERITANCE
                  return
             payload = {
                 'candidate': {
-                    'candidate': obj.candidate,
+                    'candidate': 'candidate:' + candidate_to_sdp(obj),
                     'sdpMid': obj.sdpMid,
                     'sdpMLineIndex': obj.sdpMLineIndex,
                 },
                 'type': 'candidate' # PeerJS seems to use this structure
             }
-            if not self._target_peer_id:
-                 await message_queue.put("[System] Cannot send CANDIDATE: Target Peer ID not set.")
+            if not dst:
+                 await app.messages.put("[System] Cannot send CANDIDATE: Target Peer ID not set.")
                  return
-            message = {'type': 'CANDIDATE', 'payload': payload, 'dst': self._target_peer_id, 'src': self._peer_id}
-            await self._websocket.send_json(message)
-            # await message_queue.put(f"[Signal] Sent CANDIDATE to {self._target_peer_id}") # Too verbose
+            message = {'type': 'CANDIDATE', 'payload': payload, 'dst': dst, 'src': self._peer_id}
+            await self._send_json(message)
+            # await app.messages.put(f"[Signal] Sent CANDIDATE to {dst}") # Too verbose
         elif obj is BYE:
             # Send LEAVE (PeerJS format)
-            if self._target_peer_id:
-                message = {'type': 'LEAVE', 'dst': self._target_peer_id, 'src': self._peer_id}
-                await self._websocket.send_json(message)
-                await message_queue.put(f"[Signal] Sent LEAVE to {self._target_peer_id}")
+            if dst:
+                message = {'type': 'LEAVE', 'dst': dst, 'src': self._peer_id}
+                await self._send_json(message)
+                await app.messages.put(f"[Signal] Sent LEAVE to {dst}")
+
+# --- Receive Pipeline ---
+# Decoding (JSON parsing, base64, decryption, decompression, UTF-8) is split
+# from delivery (queueing text, writing chunks, updating the mesh). Frames under
+# DECODE_OFFLOAD_SIZE decode inline on the event loop; larger ones decode on a
+# small thread pool so a big transfer can't stall SCTP/DTLS for every other
+# peer. NumPy XOR, zlib and hashing release the GIL, so threads are enough.
+# Delivery always happens on the loop, in the order each peer sent its frames.
+DECODE_OFFLOAD_SIZE = 4096 # Bytes; chat-sized frames stay inline
+DECODE_WORKERS = min(4, os.cpu_count() or 1)
+
+def decode_binary_frame(message, key_bytes):
+    """Decodes a binary frame (see Wire Format) into a delivery tuple."""
+    frame_type, sender, seq, payload = decode_frame(message)
+    codec = frame_type >> FRAME_CODEC_SHIFT
+    frame_type &= FRAME_TYPE_MASK
+    if frame_type == FRAME_TEXT:
+        with metrics.timer('kqsp_decrypt_seconds'):
+            decrypted_bytes = xor_crypt(payload, key_bytes)
+        if codec != CODEC_NONE:
+            decrypted_bytes = decompress_payload(codec, decrypted_bytes)
+        return ('text', sender, decrypted_bytes.decode('utf-8'))
+    if frame_type == FRAME_FILE_CHUNK:
+        transfer_id, offset = FILE_CHUNK_HEADER.unpack_from(payload)
+        return decode_chunk(transfer_id.hex(), offset, payload[FILE_CHUNK_HEADER.size:], key_bytes, codec)
+    return ('unknown', frame_type)
+
+def decode_chunk(transfer_id, offset, encrypted_bytes, key_bytes, codec=CODEC_NONE):
+    try:
+        return ('file-chunk', transfer_id, offset, decrypt_file_chunk(encrypted_bytes, key_bytes, offset, codec), None)
+    except ValueError as e:
+        return ('file-chunk', transfer_id, offset, None, e)
+
+def decode_message(message, key_bytes, relay_key_bytes):
+    """Decodes one data-channel message without touching shared state other than metrics.
 
+    Binary frames are decrypted with `relay_key_bytes`, JSON frames with the
+    direct group key `key_bytes` (see Group Key).
+
+    Returns ('text', sender, text), ('file-chunk', transfer_id, offset, chunk,
+    error), ('audio', sender, saved_path), ('web-file', sender, filename,
+    saved_path or None if it was password-protected), ('json', payload) for
+    control frames, or ('unknown', type).
+    """
+    if isinstance(message, bytes):
+        return decode_binary_frame(message, relay_key_bytes)
+    # Text messages are the JSON envelope
+    with metrics.timer('kqsp_json_decode_seconds'):
+        payload = json.loads(message)
+    if payload.get('type') == 'text':
+        with metrics.timer('kqsp_decrypt_seconds'):
+            decrypted_bytes = xor_crypt(payload['text'].encode('latin-1'), key_bytes)
+        return ('text', payload['from'], decrypted_bytes.decode('utf-8'))
+    if payload.get('type') == 'file-chunk':
+        return decode_chunk(payload['id'], payload['offset'], base64.b64decode(payload['data']), key_bytes)
+    if payload.get('type') == 'audio':
+        return ('audio', payload['from'], save_audio_message(payload['data'], payload.get('mimeType')))
+    if payload.get('type') == 'file': # The web client's whole-file frame
+        if payload.get('protected'): # Keyed by a password we can't prompt for
+            return ('web-file', payload['from'], payload['filename'], None)
+        return ('web-file', payload['from'], payload['filename'], save_web_file(payload['data'], payload['filename'], key_bytes))
+    return ('json', payload)
+
+async def deliver_message(decoded, peer_id):
+    """Acts on a decode_message result. Runs on the event loop."""
+    kind = decoded[0]
+    if kind == 'text':
+        await app.messages.put(f"{decoded[1]}: {decoded[2]}")
+    elif kind == 'file-chunk':
+        await receive_file_chunk(peer_id, *decoded[1:])
+    elif kind == 'audio':
+        await app.messages.put(f"[Audio] {decoded[1]}: voice message saved to {decoded[2]}")
+    elif kind == 'web-file':
+        _, sender, filename, path = decoded
+        if path is None:
+            await app.messages.put(f"[System] Skipped password-protected '{filename}' from {sender}, open it in the web client.")
+        else:
+            await app.messages.put(f"[System] Received '{filename}' from {sender}, saved to {path}")
+    elif kind == 'json':
+        payload = decoded[1]
+        if payload.get('type') == 'hello':
+            app.mesh.handle_hello(peer_id, payload)
+        elif payload.get('type') == 'members':
+            app.mesh.handle_members(peer_id, payload)
+        elif payload.get('type') in ('log-ack', 'file-ack'):
+            if app.message_log is not None:
+                app.message_log.handle_ack(peer_id, payload)
+        elif payload.get('type') in ('file-start', 'file-end'):
+            await handle_file_message(payload, peer_id)
+        elif payload.get('type') == 'file-cancel':
+            await handle_file_cancel(payload, peer_id)
+        else:
+            await app.messages.put(f"[System] Received unknown message type from {peer_id}: {payload.get('type')}")
+    else:
+        await app.messages.put(f"[System] Received unknown frame type from {peer_id}: {decoded[1]}")
+
+class ReceivePipeline:
+    """Decodes incoming messages inline or on a bounded pool, delivering per-peer in order."""
+    def __init__(self, workers=DECODE_WORKERS):
+        self.workers = workers
+        self._executor = None # Created on first offload
+        self._slots = None    # Caps decodes queued on the pool
+        self._tails = {}      # peer_id -> future done once that peer's latest message is delivered
+
+    async def submit(self, peer_id, message):
+        """Decodes and delivers `message`. Exceptions from either step propagate."""
+        loop = asyncio.get_running_loop()
+        previous = self._tails.get(peer_id)
+        done = loop.create_future()
+        self._tails[peer_id] = done
+        try:
+            if len(message) < DECODE_OFFLOAD_SIZE:
+                with metrics.timer('kqsp_decode_seconds', path='inline'):
+                    decoded = decode_message(message, group_key, relay_key)
+            else:
+                decoded = await self._offload(loop, message, group_key, relay_key)
+            if previous is not None and not previous.done():
+                metrics.inc('kqsp_decode_reordered_total')
+                await previous # Earlier frames from this peer are still decoding
+            await deliver_message(decoded, peer_id)
+        finally:
+            done.set_result(None)
+            if self._tails.get(peer_id) is done:
+                del self._tails[peer_id]
+
+    async def _offload(self, loop, message, key_bytes, relay_key_bytes):
+        if self._executor is None:
+            self._executor = concurrent.futures.ThreadPoolExecutor(self.workers, thread_name_prefix='kqsp-decode')
+            self._slots = asyncio.Semaphore(self.workers * 2)
+        metrics.inc('kqsp_decode_offloaded_total')
+        async with self._slots:
+            with metrics.timer('kqsp_decode_seconds', path='pool'):
+                return await loop.run_in_executor(self._executor, decode_message, message, key_bytes, relay_key_bytes)
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+# --- Relay ---
+# Every CLI peer understands relayed frames (RELAY_CAP) and drops duplicates by
+# message ID: the origin's K(addr) + seq, from the header of binary frames and
+# from the 'from'/'seq' fields of the few JSON control frames that get relayed.
+# Every send takes a fresh seq, so a deliberate re-send (a replayed or resumed
+# transfer) is never mistaken for a duplicate. Nodes started with --relay also
+# re-forward ciphertext they receive to their other RELAY_CAP neighbours,
+# wrapped in a FRAME_RELAY that counts hops, through a bounded queue per
+# destination so one slow peer can't hold frames for everyone.
+#
+# A relayed peer never connects to most of the group, so relay nodes announce
+# the members behind them in a 'members' frame (split horizon: nothing learned
+# from a neighbour is announced back to it). Peers fold those IDs into the
+# relay key, which encrypts binary frames, keeping one key across the relayed
+# group. JSON frames stay on the direct group key the web client derives, so
+# browsers next to a relay node keep working, but they are not part of the
+# relayed group: they don't advertise RELAY_CAP, nothing they send is
+# forwarded (relayed members couldn't decrypt it) and no relayed frame is sent
+# to them.
+RELAY_CAP = 'relay-v1'        # Understands FRAME_RELAY and 'members' frames
+RELAY_NODE_CAP = 'relay-node' # Forwards for others and announces members (--relay)
+RELAY_MAX_HOPS = 4
+RELAY_QUEUE_LIMIT = 256       # Frames queued per destination before the oldest is dropped
+RELAY_SEEN_LIMIT = 8192       # Message IDs remembered for duplicate suppression
+RELAYED_JSON_TYPES = ('file-start', 'file-end') # Binary frames carry everything else
+RELAY_INNER_BINARY = 0
+RELAY_INNER_JSON = 1
+# Prefix of a FRAME_RELAY payload: hop count, inner message kind
+RELAY_HEADER = struct.Struct('!BB')
+
+def message_id(message):
+    """Stable ID of a relayable message, the same on every path it takes."""
+    if isinstance(message, str):
+        payload = json.loads(message)
+        if 'seq' in payload:
+            return f"{payload.get('from')}/{payload['seq']}".encode('utf-8')
+        return hashlib.blake2b(message.encode('utf-8'), digest_size=8).digest() # Sent without a seq
+    # Sender address and seq straight from the header (see Wire Format)
+    return bytes(message[4:12])
+
+class Relay:
+    """Duplicate suppression for everyone, forwarding when enabled."""
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self._seen = collections.OrderedDict() # message ID -> None, oldest first
+        self._queues = {}    # peer_id -> deque of frames waiting to be forwarded
+        self._pumps = {}     # peer_id -> task draining that queue
+        self._wakeups = {}   # peer_id -> asyncio.Event set when the queue has frames
+        self._announced = {} # peer_id -> member IDs last announced to that peer
+
+    def caps(self):
+        return [RELAY_CAP, RELAY_NODE_CAP] if self.enabled else [RELAY_CAP]
+
+    def first_sighting(self, msg_id):
+        """Records `msg_id`, returning False if it was already seen."""
+        if msg_id in self._seen:
+            self._seen.move_to_end(msg_id)
+            return False
+        self._seen[msg_id] = None
+        if len(self._seen) > RELAY_SEEN_LIMIT:
+            self._seen.popitem(last=False)
+        return True
+
+    async def receive(self, peer_id, message):
+        """Handles a message from a RELAY_CAP peer: unwrap, dedupe, forward, deliver."""
+        hops = 0
+        relayed = False
+        if isinstance(message, bytes):
+            frame_type, origin, seq, payload = decode_frame(message)
+            if frame_type & FRAME_TYPE_MASK == FRAME_RELAY:
+                relayed = True
+                hops, kind = RELAY_HEADER.unpack_from(payload)
+                message = bytes(payload[RELAY_HEADER.size:])
+                if kind == RELAY_INNER_JSON:
+                    message = message.decode('utf-8')
+                    origin = json.loads(message).get('from', peer_id)
+                else:
+                    origin = decode_frame(message)[1]
+        else:
+            payload = json.loads(message)
+            if payload.get('type') not in RELAYED_JSON_TYPES:
+                await app.receive_pipeline.submit(peer_id, message) # hello, members, ...
+                return
+            origin = payload.get('from', peer_id)
+        if relayed and (origin == f"K({MY_DISPLAY_ADDR})" or origin in app.mesh.origins):
+            # Our own frame coming back, or one whose origin also sends it to us
+            # directly. Only the direct copy counts, so that origin's frames
+            # arrive in the order it sent them.
+            metrics.inc('kqsp_relay_duplicates_total')
+            return
+        if not self.first_sighting(message_id(message)):
+            metrics.inc('kqsp_relay_duplicates_total')
+            return
+        if self.enabled and hops < RELAY_MAX_HOPS:
+            self.forward(message, hops + 1, peer_id)
+        # Delivered under the origin's K(addr) whichever path it took, so its
+        # transfers and ordering never split across two keys
+        await app.receive_pipeline.submit(origin, message)
+
+    def forward(self, message, hops, from_peer):
+        """Queues `message` for every other RELAY_CAP neighbour that can decode it."""
+        codec = CODEC_NONE
+        if isinstance(message, str):
+            kind, inner = RELAY_INNER_JSON, message.encode('utf-8')
+        else:
+            kind, inner = RELAY_INNER_BINARY, message
+            codec = message[3] >> FRAME_CODEC_SHIFT
+        frame = None
+        for peer_id, channel in app.mesh.chat_channels.items():
+            caps = app.mesh.capabilities.get(peer_id, ())
+            if peer_id == from_peer or RELAY_CAP not in caps:
+                continue
+            if codec != CODEC_NONE and CODEC_NAMES.get(codec) not in caps:
+                metrics.inc('kqsp_relay_skipped_total', reason='codec')
+                continue
+            if frame is None: # Wrapped once, shared by every destination
+                frame = encode_frame(FRAME_RELAY, next_seq(), RELAY_HEADER.pack(hops, kind), inner)
+            self._enqueue(peer_id, channel, frame)
+
+    def _enqueue(self, peer_id, channel, frame):
+        queue = self._queues.get(peer_id)
+        if queue is None:
+            queue = self._queues[peer_id] = collections.deque(maxlen=RELAY_QUEUE_LIMIT)
+            self._wakeups[peer_id] = asyncio.Event()
+            self._pumps[peer_id] = asyncio.create_task(self._pump(peer_id, channel))
+        if len(queue) == RELAY_QUEUE_LIMIT:
+            metrics.inc('kqsp_relay_dropped_total') # deque drops the oldest frame
+        queue.append(frame)
+        self._wakeups[peer_id].set()
+        metrics.inc('kqsp_relay_forwarded_total')
+
+    async def _pump(self, peer_id, channel):
+        queue = self._queues[peer_id]
+        wakeup = self._wakeups[peer_id]
+        sender = get_sender(channel)
+        while True:
+            if not queue:
+                wakeup.clear()
+                await wakeup.wait()
+                continue
+            try:
+                await sender.send(queue.popleft(), bulk=True)
+            except (ConnectionError, TimeoutError): # Channel closed or stopped draining
+                self.forget(peer_id)
+                return
+
+    def announce(self):
+        """Sends each RELAY_CAP neighbour the members reachable through us, if changed."""
+        if not self.enabled:
+            return
+        for peer_id, channel in app.mesh.chat_channels.items():
+            if RELAY_CAP not in app.mesh.capabilities.get(peer_id, ()):
+                continue
+            ids = sorted(app.mesh.group_member_ids(exclude_learned_from=peer_id))
+            if self._announced.get(peer_id) == ids:
+                continue
+            self._announced[peer_id] = ids
+            try:
+                channel.send(json.dumps({'type': 'members', 'from': f"K({MY_DISPLAY_ADDR})", 'ids': ids}))
+            except Exception as e: # Closing channel, its close handler cleans up
+                logging.debug("members announcement to %s failed: %s", peer_id, e)
+
+    def forget(self, peer_id):
+        self._announced.pop(peer_id, None)
+        self._queues.pop(peer_id, None)
+        self._wakeups.pop(peer_id, None)
+        pump = self._pumps.pop(peer_id, None)
+        if pump is not None and pump is not asyncio.current_task():
+            pump.cancel()
+
+# --- Message Log ---
+# With --message-log DIR (one directory per group), everything we send to the
+# group is also appended to an on-disk log, so peers that drop off get it when
+# they come back. The log is a run of fixed-size, memory-mapped segment files
+# named after their first sequence number. Records are
+# LOG_RECORD header + payload. Payloads are XORed with a keystream derived per
+# segment from log.key, which only keeps plaintext out of casual disk scans:
+# the key sits in the same directory, so this is obfuscation, not encryption.
+# Anyone who can read the directory can read the log. Old segments are dropped
+# once the log passes LOG_MAX_BYTES or LOG_MAX_AGE.
+#
+# Each member has a delivery cursor: every record up to it was delivered, plus
+# the set of delivered records above it. Peers advertising LOG_CAP ack text
+# frames by frame seq ('log-ack') and finished transfers by id ('file-ack').
+# When a known member says hello again, records it is missing are re-sent
+# under the current group key, and an unfinished file resumes from the offset
+# the receiver reports. Web clients never say hello, so a peer still silent
+# LOG_HELLO_GRACE after its chat channel opened is caught up then; it gets
+# the text records, streamed files being out of its reach. New members start
+# at the end of the log.
+LOG_CAP = 'log-v1'            # Acks frames and can resume transfers
+LOG_NODE_CAP = 'log-node'     # Keeps a message log, wants acks (--message-log)
+LOG_SEGMENT_SIZE = 8 * 1024 * 1024
+LOG_MAX_BYTES = 256 * 1024 * 1024
+LOG_MAX_AGE = 7 * 24 * 3600   # Seconds
+LOG_ACK_DELAY = 0.2           # Receivers batch acks for this long
+LOG_CURSOR_FLUSH = 1.0        # Seconds between cursor file writes
+LOG_RESUME_TIMEOUT = 10.0     # Wait for a receiver's resume offset
+LOG_HELLO_GRACE = 2.0         # Seconds a newly opened peer has to say hello before it's taken for a web client
+RECORD_TEXT = 1
+RECORD_FILE = 2
+RECORD_MAGIC = b'KL'
+# magic, kind, log seq, unix time, payload length
+LOG_RECORD = struct.Struct('!2sBQdI')
+
+class LogSegment:
+    """One fixed-size, memory-mapped log segment."""
+    def __init__(self, path, base_seq, log_key):
+        self.path = path
+        self.base_seq = base_seq
+        self._key = hashlib.sha256(log_key + base_seq.to_bytes(8, 'big')).digest()
+        self._file = open(path, 'r+b' if os.path.exists(path) else 'w+b')
+        if os.fstat(self._file.fileno()).st_size < LOG_SEGMENT_SIZE:
+            self._file.truncate(LOG_SEGMENT_SIZE) # Sparse until written
+        self._map = mmap.mmap(self._file.fileno(), LOG_SEGMENT_SIZE)
+        self.used = 0
+        self.last_seq = base_seq - 1
+        self.last_time = 0.0
+        for seq, kind, when, start, length in self._scan():
+            self.last_seq, self.last_time, self.used = seq, when, start + length
+
+    def _scan(self, pos=0):
+        while pos + LOG_RECORD.size <= LOG_SEGMENT_SIZE:
+            magic, kind, seq, when, length = LOG_RECORD.unpack_from(self._map, pos)
+            start = pos + LOG_RECORD.size
+            if magic != RECORD_MAGIC or start + length > LOG_SEGMENT_SIZE:
+                return # End of the written part
+            yield seq, kind, when, start, length
+            pos = start + length
+
+    def append(self, kind, seq, payload):
+        """Writes a record, returning False if the segment has no room left."""
+        start = self.used + LOG_RECORD.size
+        if start + len(payload) > LOG_SEGMENT_SIZE:
+            return False
+        when = time.time()
+        self._map[start:start + len(payload)] = xor_crypt(payload, self._key, start)
+        # Header last, so a torn write never looks like a record
+        LOG_RECORD.pack_into(self._map, self.used, RECORD_MAGIC, kind, seq, when, len(payload))
+        self.used = start + len(payload)
+        self.last_seq, self.last_time = seq, when
+        return True
+
+    def records(self, after_seq):
+        """Yields (seq, kind, payload) for records after `after_seq`."""
+        for seq, kind, when, start, length in self._scan():
+            if seq > after_seq:
+                yield seq, kind, xor_crypt(self._map[start:start + length], self._key, start)
+
+    def flush(self):
+        self._map.flush()
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+class PeerCursor:
+    """How far one member has received our log."""
+    def __init__(self, cursor, acked=()):
+        self.cursor = cursor     # Every record <= cursor is delivered
+        self.acked = set(acked)  # Delivered records above the cursor
+        self.text_frames = collections.OrderedDict() # frame seq -> record seq, awaiting 'log-ack'
+        self.files = {}          # transfer id -> record seq, awaiting 'file-ack'
+
+    def in_flight(self):
+        return set(self.text_frames.values()) | set(self.files.values())
+
+    def delivered(self, record_seq):
+        if record_seq > self.cursor:
+            self.acked.add(record_seq)
+        while self.cursor + 1 in self.acked:
+            self.cursor += 1
+            self.acked.remove(self.cursor)
+
+class MessageLog:
+    """Persistent log of what we sent the group, with per-member delivery cursors."""
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        key_path = os.path.join(directory, 'log.key')
+        if not os.path.exists(key_path):
+            fd = os.open(key_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+            with os.fdopen(fd, 'wb') as f:
+                f.write(os.urandom(32))
+        with open(key_path, 'rb') as f:
+            self._key = f.read()
+        self.segments = []
+        for name in sorted(os.listdir(directory)):
+            if name.endswith('.seg'):
+                self.segments.append(LogSegment(os.path.join(directory, name), int(name[:-4]), self._key))
+        self.last_seq = self.segments[-1].last_seq if self.segments else 0
+        self.cursors = {} # member ID -> PeerCursor
+        self._cursor_path = os.path.join(directory, 'cursors.json')
+        try:
+            with open(self._cursor_path) as f:
+                for member_id, state in json.load(f).items():
+                    self.cursors[member_id] = PeerCursor(state['cursor'], state.get('acked', ()))
+        except (OSError, ValueError, KeyError):
+            pass
+        self.replaying = set()   # peer IDs being caught up; live sends skip them
+        self._offsets = {}       # (peer_id, transfer id) -> future for the resume offset
+        self._hello_waits = {}   # peer_id -> handle replaying to it if no hello comes
+        self._flush_handle = None
+        self.compact()
+
+    # Storage
+    def append(self, kind, payload):
+        """Appends a record and returns its sequence number."""
+        seq = self.last_seq + 1
+        if not self.segments or not self.segments[-1].append(kind, seq, payload):
+            if LOG_RECORD.size + len(payload) > LOG_SEGMENT_SIZE:
+                raise ValueError("record too large for the message log")
+            path = os.path.join(self.directory, f"{seq:020d}.seg")
+            self.segments.append(LogSegment(path, seq, self._key))
+            self.segments[-1].append(kind, seq, payload)
+            self.compact()
+        self.last_seq = seq
+        metrics.inc('kqsp_log_records_total')
+        self._schedule_flush()
+        return seq
+
+    def records(self, after_seq):
+        for segment in self.segments:
+            if segment.last_seq > after_seq:
+                yield from segment.records(after_seq)
+
+    def compact(self):
+        """Drops the oldest segments past the size or age limit (never the active one)."""
+        cutoff = time.time() - LOG_MAX_AGE
+        total = sum(segment.used for segment in self.segments)
+        while len(self.segments) > 1:
+            oldest = self.segments[0]
+            if total <= LOG_MAX_BYTES and oldest.last_time >= cutoff:
+                break
+            total -= oldest.used
+            oldest.close()
+            os.remove(oldest.path)
+            del self.segments[0]
+            metrics.inc('kqsp_log_segments_compacted_total')
+
+    def _schedule_flush(self):
+        if self._flush_handle is None:
+            self._flush_handle = asyncio.get_running_loop().call_later(LOG_CURSOR_FLUSH, self.flush)
+
+    def flush(self):
+        """Syncs the active segment and rewrites the cursor file."""
+        self._flush_handle = None
+        if self.segments:
+            self.segments[-1].flush()
+        state = {m: {'cursor': c.cursor, 'acked': sorted(c.acked)} for m, c in self.cursors.items()}
+        tmp_path = self._cursor_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp_path, self._cursor_path)
+
+    def close(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+        self.flush()
+        for segment in self.segments:
+            segment.close()
+
+    # Delivery tracking
+    def cursor_for(self, peer_id):
+        member_id = app.mesh.member_ids.get(peer_id)
+        if member_id is None:
+            return None
+        cursor = self.cursors.get(member_id)
+        if cursor is None: # New member, nothing from before it joined is owed
+            cursor = self.cursors[member_id] = PeerCursor(self.last_seq)
+            self._schedule_flush()
+        return cursor
+
+    def sent(self, peer_id, record_seq, frame_seq=None, transfer_id=None):
+        """Notes that a record went out to `peer_id`; delivered now unless the peer acks."""
+        cursor = self.cursor_for(peer_id)
+        if cursor is None:
+            return
+        if LOG_CAP not in app.mesh.capabilities.get(peer_id, ()):
+            cursor.delivered(record_seq)
+        elif transfer_id is not None:
+            cursor.files[transfer_id] = record_seq
+        else:
+            cursor.text_frames[frame_seq] = record_seq
+        self._schedule_flush()
+
+    def handle_ack(self, peer_id, payload):
+        cursor = self.cursor_for(peer_id)
+        if cursor is None:
+            return
+        if payload['type'] == 'log-ack':
+            while cursor.text_frames:
+                frame_seq, record_seq = next(iter(cursor.text_frames.items()))
+                if frame_seq > payload['seq']:
+                    break
+                cursor.text_frames.popitem(last=False)
+                cursor.delivered(record_seq)
+        else: # 'file-ack'
+            future = self._offsets.pop((peer_id, payload['id']), None)
+            if future is not None and not future.done():
+                future.set_result(payload.get('offset', 0))
+            if payload.get('done') and payload['id'] in cursor.files:
+                cursor.delivered(cursor.files.pop(payload['id']))
+        self._schedule_flush()
+
+    def channel_opened(self, peer_id):
+        """Replays to `peer_id` after LOG_HELLO_GRACE unless its hello does it first."""
+        def replay_without_hello():
+            self._hello_waits.pop(peer_id, None)
+            if peer_id not in app.mesh.capabilities: # Still no hello, a web client
+                asyncio.create_task(self.replay(peer_id))
+        self._hello_waits[peer_id] = asyncio.get_running_loop().call_later(LOG_HELLO_GRACE, replay_without_hello)
+
+    def disconnected(self, peer_id):
+        """Forgets in-flight state; anything unacked is replayed next time."""
+        wait = self._hello_waits.pop(peer_id, None)
+        if wait is not None:
+            wait.cancel()
+        cursor = self.cursors.get(app.mesh.member_ids.get(peer_id))
+        if cursor is not None:
+            cursor.text_frames.clear()
+            cursor.files.clear()
+        self.replaying.discard(peer_id)
+        for key in [k for k in self._offsets if k[0] == peer_id]:
+            self._offsets.pop(key).cancel()
+
+    async def replay(self, peer_id):
+        """Re-sends every record `peer_id` is missing, oldest first."""
+        wait = self._hello_waits.pop(peer_id, None)
+        if wait is not None:
+            wait.cancel()
+        cursor = self.cursor_for(peer_id)
+        channel = app.mesh.chat_channels.get(peer_id)
+        if cursor is None or channel is None or peer_id in self.replaying:
+            return
+        self.replaying.add(peer_id)
+        if self.segments and cursor.cursor < self.segments[0].base_seq - 1: # Compacted away
+            cursor.cursor = self.segments[0].base_seq - 1
+            cursor.acked = {seq for seq in cursor.acked if seq > cursor.cursor}
+            cursor.delivered(cursor.cursor)
+        replayed = 0
+        try:
+            while peer_id in self.replaying:
+                skip = cursor.acked | cursor.in_flight()
+                pending = [r for r in self.records(cursor.cursor) if r[0] not in skip]
+                if not pending: # Caught up, live sends take over
+                    break
+                for record_seq, kind, payload in pending:
+                    if kind == RECORD_TEXT:
+                        frame_seq, make_binary, make_json = build_text_frames(bytes(payload))
+                        results = await broadcast_formats(make_binary, make_json, {peer_id: channel})
+                        if results.get(peer_id) is not None:
+                            return
+                        self.sent(peer_id, record_seq, frame_seq=frame_seq)
+                    elif kind == RECORD_FILE and WIRE_BINARY not in app.mesh.capabilities.get(peer_id, ()):
+                        filename = json.loads(bytes(payload))['filename']
+                        await app.messages.put(f"[System] Not replaying '{filename}' to web peer {peer_id}: it can't receive streamed files.")
+                        cursor.delivered(record_seq)
+                        self._schedule_flush()
+                        continue
+                    elif kind == RECORD_FILE:
+                        if not await self._resume_file(peer_id, channel, record_seq, json.loads(bytes(payload))):
+                            return
+                    replayed += 1
+        finally:
+            self.replaying.discard(peer_id)
+            if replayed:
+                metrics.inc('kqsp_log_replayed_total', replayed)
+                await app.messages.put(f"[System] Replayed {replayed} missed message(s) to {peer_id}.")
+
+    async def _resume_file(self, peer_id, channel, record_seq, info):
+        """Continues a logged transfer to one peer from wherever it got to."""
+        if not os.path.exists(info['path']): # Gone from disk, nothing left to deliver
+            self.cursor_for(peer_id).delivered(record_seq)
+            return True
+        targets = {peer_id: channel}
+        def file_start(resume):
+            return json.dumps({'type': 'file-start', 'from': f"K({MY_DISPLAY_ADDR})", 'id': info['id'],
+                               'filename': info['filename'], 'size': info['size'], 'resume': resume,
+                               'seq': next_seq()})
+        future = asyncio.get_running_loop().create_future()
+        self._offsets[peer_id, info['id']] = future
+        if (await broadcast(file_start(True), targets)).get(peer_id) is not None:
+            return False
+        try:
+            offset = await asyncio.wait_for(future, LOG_RESUME_TIMEOUT)
+        except asyncio.TimeoutError:
+            # No offset came back, so start the transfer over rather than send chunks it can't place
+            self._offsets.pop((peer_id, info['id']), None)
+            if (await broadcast(file_start(False), targets)).get(peer_id) is not None:
+                return False
+            offset = 0
+        except asyncio.CancelledError: # Peer went away
+            return False
+        if not await send_cli_file(info['path'], targets=targets, transfer_id=info['id'], offset=offset):
+            return False
+        self.sent(peer_id, record_seq, transfer_id=info['id'])
+        return True
+
+class LogAcks:
+    """Receiver side: batches 'log-ack' frames back to peers that keep a log."""
+    def __init__(self):
+        self._highest = {} # peer_id -> highest frame seq not yet acked
+        self._handles = {}
+
+    def note(self, peer_id, message):
+        seq = FRAME_HEADER.unpack_from(message)[4]
+        if seq > self._highest.get(peer_id, -1):
+            self._highest[peer_id] = seq
+        if peer_id not in self._handles:
+            self._handles[peer_id] = asyncio.get_running_loop().call_later(LOG_ACK_DELAY, self._send, peer_id)
+
+    def _send(self, peer_id):
+        self._handles.pop(peer_id, None)
+        seq = self._highest.pop(peer_id, None)
+        channel = app.mesh.chat_channels.get(peer_id)
+        if seq is not None and channel is not None and channel.readyState == 'open':
+            channel.send(json.dumps({'type': 'log-ack', 'seq': seq}))
+
+    def forget(self, peer_id):
+        handle = self._handles.pop(peer_id, None)
+        if handle is not None:
+            handle.cancel()
+        self._highest.pop(peer_id, None)
+
+def log_caps():
+    return [LOG_CAP, LOG_NODE_CAP] if app.message_log is not None else [LOG_CAP]
 # --- WebRTC Data Channel Handling ---
 async def handle_data_channel(channel, peer_id):
     """Handles messages received on a data channel."""
-    await message_queue.put(f"[System] Data channel '{channel.label}' created with {peer_id}")
-    update_group_key({pc.remoteDescription.sdp.split('o=')[1].split(' ')[0] for pc in pcs if pc.remoteDescription}) # Update key on new channel
+    await app.messages.put(f"[System] Data channel '{channel.label}' created with {peer_id}")
 
     @channel.on("message")
     async def on_message(message):
+        metrics.inc('kqsp_frames_received_total', format='binary' if isinstance(message, bytes) else 'json')
+        metrics.inc('kqsp_bytes_received_total', len(message))
+        caps = app.mesh.capabilities.get(peer_id, ())
         try:
-            # Assume message is JSON payload as string
-            payload = json.loads(message)
-            if payload.get('type') == 'text':
-                encrypted_text_bytes = payload['text'].encode('latin-1')
-                decrypted_bytes = xor_crypt(encrypted_text_bytes, group_key)
-                await message_queue.put(f"{payload['from']}: {decrypted_bytes.decode('utf-8')}")
-            # Add handlers for 'file', 'audio' later
+            if isinstance(message, bytes) and LOG_NODE_CAP in caps:
+                app.log_acks.note(peer_id, message)
+            if RELAY_CAP in caps:
+                await app.relay.receive(peer_id, message)
             else:
-                await message_queue.put(f"[System] Received unknown message type from {peer_id}: {payload.get('type')}")
-        except (json.JSONDecodeError, UnicodeDecodeError, KeyError, AttributeError) as e:
-            await message_queue.put(f"[System] Error processing message from {peer_id} on channel {channel.label}: {e}")
+                await app.receive_pipeline.submit(peer_id, message)
+        except (json.JSONDecodeError, UnicodeDecodeError, KeyError, AttributeError, ValueError, struct.error, OSError) as e:
+            await app.messages.put(f"[System] Error processing message from {peer_id} on channel {channel.label}: {e}")
             # Log raw message for debugging if not JSON
             if isinstance(message, str):
-                 await message_queue.put(f"[System] Raw data: {message[:100]}...")
+                 await app.messages.put(f"[System] Raw data: {message[:100]}...")
             else:
-                 await message_queue.put(f"[System] Received non-string data: {type(message)}")
+                 await app.messages.put(f"[System] Received non-string data: {type(message)}")
 
     @channel.on("close")
     async def on_close():
-        await message_queue.put(f"[System] Data channel '{channel.label}' closed with {peer_id}")
+        await app.messages.put(f"[System] Data channel '{channel.label}' closed with {peer_id}")
+        sender = app.channel_senders.pop(channel, None)
+        if sender:
+            sender.close()
         # Find the peer connection associated with this channel to remove if needed
         # This part is tricky as channel doesn't directly link back to pc easily
         # We might need to manage connections differently
 
-# --- Main Application Logic ---
-async def run(pc, signaling, role, target_peer=None): # Added target_peer
-    """Main coroutine for handling a single peer connection."""
-    connected_peer_ids = set()
-    signaling._target_peer_id = target_peer # Pass target to signaling instance
-
-    def get_peer_id(pc_obj):
-        if pc_obj and pc_obj.remoteDescription:
-            # Attempt to extract peer ID from SDP (this is fragile)
-            try:
-                return pc_obj.remoteDescription.sdp.split('o=')[1].split(' ')[0]
-            except IndexError:
-                return "unknown-peer"
-        return "unknown-peer"
-
-    async def send_ping():
-        # Keepalive or other periodic tasks if needed
-        pass
-
-    @pc.on("datachannel")
-    async def on_datachannel(channel):
-        peer_id = get_peer_id(pc)
+# --- Peer Mesh Management ---
+class PeerManager:
+    """Runs one RTCPeerConnection per remote peer under a single signaling socket.
+
+    Connections are keyed by the remote peer ID (the signaling `src`/`dst`).
+    The registry below is maintained from the datachannel / open / close /
+    connectionstatechange events, so sends and group-key updates never have
+    to scan channels or parse SDP.
+    """
+    def __init__(self):
+        self.peers = {}         # peer_id -> RTCPeerConnection
+        self.channels = {}      # peer_id -> {label: open RTCDataChannel}
+        self.chat_channels = {} # peer_id -> open 'kqsp-chat' RTCDataChannel
+        self.capabilities = {}  # peer_id -> wire capabilities from the peer's hello
+        self.member_ids = {}    # peer_id -> ID the peer counts as in the group key
+        self.learned_members = {} # relay peer_id -> member IDs it announced (see Relay)
+        self.origins = {}       # K(addr) from a peer's hello -> peer_id
+
+    def get_or_create(self, peer_id):
+        """Returns the connection for `peer_id`, creating and wiring it if new."""
+        pc = self.peers.get(peer_id)
+        if pc is not None:
+            return pc
+        from aiortc import RTCPeerConnection
+        pc = RTCPeerConnection()
+        self.peers[peer_id] = pc
+
+        @pc.on("datachannel")
+        def on_datachannel(channel):
+            self._track_channel(peer_id, channel)
+
+        @pc.on("track")
+        async def on_track(track):
+            if track.kind == 'audio' and app.live_audio is not None:
+                await app.live_audio.record(peer_id, track)
+
+        @pc.on("connectionstatechange")
+        async def on_connectionstatechange():
+            state = pc.connectionState
+            if self.peers.get(peer_id) is not pc: # Replaced or already removed
+                return
+            await app.messages.put(f"[System] Connection state with {peer_id} is {state}")
+            if state in ("failed", "closed", "disconnected"):
+                await self.remove(peer_id)
+            elif state == "connected":
+                await app.messages.put(f"[System] Connected to {peer_id}!")
+
+        return pc
+
+    def open_channels(self, label='kqsp-chat'):
+        """Returns {peer_id: channel} for the open channels with `label`."""
+        if label == 'kqsp-chat':
+            return dict(self.chat_channels)
+        return {peer_id: chs[label] for peer_id, chs in self.channels.items() if label in chs}
+
+    def _track_channel(self, peer_id, channel):
         asyncio.create_task(handle_data_channel(channel, peer_id))
 
-    @pc.on("connectionstatechange")
-    async def on_connectionstatechange():
-        peer_id = get_peer_id(pc)
-        state = pc.connectionState
-        await message_queue.put(f"[System] Connection state with {peer_id} is {state}")
-        if state == "failed" or state == "closed" or state == "disconnected":
-            # await signaling.send(BYE) # Let WebSocket loop handle LEAVE
-            if pc in pcs:
-                pcs.discard(pc)
-            if peer_id != "unknown-peer":
-                 connected_peer_ids.discard(peer_id)
-            update_group_key(connected_peer_ids)
+        def on_open():
+            if self.peers.get(peer_id) is None: # Peer removed before the channel opened
+                return
+            self.channels.setdefault(peer_id, {})[channel.label] = channel
+            if channel.label == 'kqsp-chat':
+                self.chat_channels[peer_id] = channel
+                # Advertise our formats; older clients just ignore the frame
+                channel.send(json.dumps({'type': 'hello', 'from': f"K({MY_DISPLAY_ADDR})", 'peer_id': MY_PEER_ID, 'caps': [WIRE_BINARY] + codec_caps() + app.relay.caps() + log_caps()}))
+                if peer_id != BASIC_PEER_ID: # Basic-signaling peers join once their hello names them
+                    self._join_group(peer_id, peer_id)
+                    if app.message_log is not None:
+                        app.message_log.channel_opened(peer_id)
+
+        def on_close():
+            chs = self.channels.get(peer_id)
+            if chs and chs.get(channel.label) is channel:
+                del chs[channel.label]
+            if self.chat_channels.get(peer_id) is channel:
+                del self.chat_channels[peer_id]
+                self._leave_group(peer_id)
+
+        if channel.readyState == 'open':
+            on_open()
+        else:
+            channel.once("open", on_open)
+        channel.on("close", on_close)
+
+    def _join_group(self, peer_id, member_id):
+        # Same membership rule as the web client: peers with an open chat channel
+        self.member_ids[peer_id] = member_id
+        group_keys.add(member_id)
+        self._sync_group()
+
+    def _leave_group(self, peer_id):
+        member_id = self.member_ids.pop(peer_id, None)
+        if member_id is not None:
+            group_keys.discard(member_id)
+        self._sync_group()
+
+    def group_member_ids(self, exclude_learned_from=None):
+        """Our direct members plus those relays announced, optionally minus one relay's."""
+        ids = {MY_PEER_ID, *self.member_ids.values()}
+        for peer_id, learned in self.learned_members.items():
+            if peer_id != exclude_learned_from:
+                ids.update(learned)
+        return ids
+
+    def _sync_group(self):
+        relay_keys.set_members(self.group_member_ids())
+
+    def handle_hello(self, peer_id, payload):
+        """Records a peer's capabilities and, if signaling didn't name it, its peer ID."""
+        self.capabilities[peer_id] = set(payload.get('caps', []))
+        if payload.get('from'):
+            self.origins[payload['from']] = peer_id
+        if peer_id not in self.member_ids and peer_id in self.chat_channels and payload.get('peer_id'):
+            self._join_group(peer_id, payload['peer_id'])
+        app.relay.announce() # A new RELAY_CAP neighbour needs our members
+        if app.message_log is not None:
+            asyncio.create_task(app.message_log.replay(peer_id))
+
+    def handle_members(self, peer_id, payload):
+        """Folds the members a relay node reaches into the relay key."""
+        if RELAY_NODE_CAP not in self.capabilities.get(peer_id, ()):
+            return
+        learned = set(payload.get('ids', []))
+        if self.learned_members.get(peer_id) != learned:
+            self.learned_members[peer_id] = learned
+            self._sync_group()
+
+    async def connect(self, peer_id):
+        """Starts a connection to `peer_id` and returns the offer to signal."""
+        if peer_id in self.peers: # Start over rather than renegotiate
+            await self.remove(peer_id)
+        pc = self.get_or_create(peer_id)
+        self._track_channel(peer_id, pc.createDataChannel("kqsp-chat")) # Use same label as web
+        if app.live_audio is not None:
+            app.live_audio.attach(pc)
+        await pc.setLocalDescription(await pc.createOffer())
+        return pc.localDescription
+
+    async def handle_offer(self, peer_id, description):
+        """Applies a remote offer and returns the answer to signal back.
+
+        When both sides offered at once, the higher peer ID keeps its own
+        offer and returns None; the lower one drops its offer and answers.
+        """
+        pc = self.peers.get(peer_id)
+        if pc is not None and pc.signalingState == 'have-local-offer' and pc.remoteDescription is None:
+            if MY_PEER_ID > peer_id:
+                return None
+            await self.remove(peer_id) # aiortc can't roll back, start this side over
+        elif pc is not None and pc.remoteDescription is not None:
+            await self.remove(peer_id) # The peer restarted, drop the stale connection
+        pc = self.get_or_create(peer_id)
+        await pc.setRemoteDescription(description)
+        if app.live_audio is not None:
+            app.live_audio.attach(pc) # Fills the offered audio transceiver, if any
+        await pc.setLocalDescription(await pc.createAnswer())
+        return pc.localDescription
+
+    async def handle_answer(self, peer_id, description):
+        pc = self.peers.get(peer_id)
+        if pc is None:
+            await app.messages.put(f"[System] Ignoring ANSWER from unknown peer {peer_id}")
+            return
+        await pc.setRemoteDescription(description)
+
+    async def handle_candidate(self, peer_id, candidate_info):
+        pc = self.peers.get(peer_id)
+        if pc is None or not candidate_info or not candidate_info.get('candidate'):
+            return
+        sdp = candidate_info['candidate']
+        if not isinstance(sdp, str) or not sdp.startswith('candidate:'):
+            raise ValueError(f"malformed ICE candidate from {peer_id}: {sdp!r}")
+        # aiortc needs the parsed candidate plus sdpMid / sdpMLineIndex
+        from aiortc.sdp import candidate_from_sdp
+        candidate = candidate_from_sdp(sdp.split(':', 1)[1])
+        candidate.sdpMid = candidate_info.get('sdpMid')
+        candidate.sdpMLineIndex = candidate_info.get('sdpMLineIndex')
+        await pc.addIceCandidate(candidate)
+
+    async def remove(self, peer_id):
+        """Closes and forgets the connection to `peer_id`, if any."""
+        pc = self.peers.pop(peer_id, None)
+        self.channels.pop(peer_id, None)
+        caps = self.capabilities.pop(peer_id, ())
+        self.chat_channels.pop(peer_id, None)
+        origins = [o for o, p in self.origins.items() if p == peer_id]
+        for origin in origins:
+            del self.origins[origin]
+        interrupt_incoming_files({peer_id, *origins}, LOG_NODE_CAP in caps)
+        app.relay.forget(peer_id)
+        app.log_acks.forget(peer_id)
+        if app.message_log is not None:
+            app.message_log.disconnected(peer_id)
+        self.learned_members.pop(peer_id, None)
+        self._leave_group(peer_id)
+        if app.live_audio is not None:
+            await app.live_audio.stop_recording(peer_id)
+        if pc is not None:
             await pc.close()
-            if not pcs: # If no connections left, stop
-                 stop_event.set()
-        elif state == "connected":
-             if peer_id != "unknown-peer":
-                 connected_peer_ids.add(peer_id)
-             update_group_key(connected_peer_ids)
-             await message_queue.put(f"[System] Connected to {peer_id}!")
 
+    async def close(self):
+        await asyncio.gather(*(self.remove(peer_id) for peer_id in list(self.peers)), return_exceptions=True)
+
+BASIC_PEER_ID = "basic-peer" # Placeholder key, basic signaling carries no peer IDs
+
+# --- Main Application Logic ---
+async def run_basic_signaling(signaling, role):
+    """Drives a single connection over aiortc's basic (TCP/Unix/copy-paste) signaling."""
+    from aiortc import RTCIceCandidate, RTCSessionDescription
+    from aiortc.contrib.signaling import BYE
+    peer_id = BASIC_PEER_ID
+    try:
+        if role == "offer":
+            await signaling.send(await app.mesh.connect(peer_id))
+        while not app.stop_event.is_set():
+            obj = await signaling.receive()
+            if isinstance(obj, RTCSessionDescription):
+                if obj.type == "offer":
+                    await signaling.send(await app.mesh.handle_offer(peer_id, obj))
+                else:
+                    await app.mesh.handle_answer(peer_id, obj)
+            elif isinstance(obj, RTCIceCandidate):
+                await app.mesh.peers[peer_id].addIceCandidate(obj)
+            elif obj is BYE or obj is None:
+                await app.messages.put("[System] Signaling peer said goodbye.")
+                await app.mesh.remove(peer_id)
+                break
+    except OSError as e:
+        await app.messages.put(f"[System] Signaling error: {e}")
+
+async def run(signaling, role, target_peers=()):
+    """Main coroutine: connects signaling and serves the peer mesh until stopped."""
     # Connect signaling
     await signaling.connect()
 
-    if role == "offer":
-        # Create data channel
-        channel = pc.createDataChannel("kqsp-chat") # Use same label as web
-        peer_id = target_peer if target_peer else "offering-peer"
-        asyncio.create_task(handle_data_channel(channel, peer_id))
-
-        # Send offer
-        await pc.setLocalDescription(await pc.createOffer())
-        await signaling.send(pc.localDescription)
-        await message_queue.put(f"[System] Sent offer to {target_peer}...")
+    if isinstance(signaling, WebSocketSignaling):
+        if role == "offer":
+            for target_peer in target_peers:
+                await signaling.send(await app.mesh.connect(target_peer), dst=target_peer)
+                await app.messages.put(f"[System] Sent offer to {target_peer}...")
+    else:
+        asyncio.create_task(run_basic_signaling(signaling, role))
 
-    # Wait for connection or stop signal
-    await stop_event.wait()
-    await message_queue.put("[System] Main loop exiting due to stop event.")
+    # Wait for stop signal; connections come and go through the mesh
+    await app.stop_event.wait()
+    await app.messages.put("[System] Main loop exiting due to stop event.")
 
 # --- User Input and Message Sending ---
-async def consume_user_input():
-    """Handles user input from stdin."""
-    loop = asyncio.get_event_loop()
-    while not stop_event.is_set():
+INPUT_PROMPT = "Enter message or command (/send <path>, /talk, /stats, /quit)"
+
+async def open_stdin_reader():
+    """Wraps stdin in an asyncio StreamReader.
+
+    Returns (reader, close), or (None, None) where stdin can't be read
+    asynchronously. connect_read_pipe makes the file description it reads
+    non-blocking, and on a terminal stdin and stdout share one, so a burst
+    written to stdout could fail with BlockingIOError. The terminal is
+    reopened for reading instead, and stdin shared with stdout any other
+    way is left to the blocking fallback.
+    """
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader()
+    stdin_fd = sys.stdin.fileno()
+    try:
+        if os.isatty(stdin_fd):
+            pipe = open(os.ttyname(stdin_fd), 'rb', buffering=0) # Our own file description
+        elif os.path.samestat(os.fstat(stdin_fd), os.fstat(sys.stdout.fileno())):
+            return None, None
+        else:
+            pipe = sys.stdin
+    except (OSError, ValueError):
+        return None, None
+    try:
+        transport, _ = await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), pipe)
+    except (NotImplementedError, ValueError, OSError): # e.g. Windows, or stdin is a regular file
+        if pipe is not sys.stdin:
+            pipe.close()
+        return None, None
+    if pipe is not sys.stdin:
+        return reader, transport.close
+
+    def close():
         try:
-            # Use run_in_executor for blocking input()
-            user_input = await loop.run_in_executor(
-                None, lambda: input("Enter message or command (/quit): ")
-            )
-            if user_input == '/quit':
-                await message_queue.put("[System] Quitting...")
-                stop_event.set()
-                break
-            elif user_input.startswith('/'):
-                await message_queue.put(f"[System] Unknown command: {user_input.split(' ')[0]}")
-            elif user_input:
-                await send_cli_message(user_input)
-        except (EOFError, KeyboardInterrupt):
-            await message_queue.put("\n[System] Input interrupted. Quitting...")
-            stop_event.set()
-            break
-        except Exception as e:
-            await message_queue.put(f"\n[System] Error reading input: {e}")
-            await asyncio.sleep(1)
+            os.set_blocking(stdin_fd, True) # connect_read_pipe left stdin non-blocking
+        except OSError:
+            pass
+    return reader, close
 
-async def send_cli_message(text):
-    """Encrypts and sends a text message to all connected peers via data channels."""
-    if not pcs:
-        await message_queue.put("[System] No active connections to send message.")
-        return
-    if not group_key:
-        await message_queue.put("[System] Group key not yet established. Cannot send message.")
-        return
+async def consume_user_input():
+    """Handles user input from stdin until EOF, /quit or cancellation."""
+    await app.messages.put(f"[System] {INPUT_PROMPT}")
+    reader, close_reader = await open_stdin_reader()
+    loop = asyncio.get_running_loop()
+
+    async def read_line():
+        if reader is None: # Fallback: blocking readline in a worker thread
+            return await loop.run_in_executor(None, sys.stdin.readline)
+        return (await reader.readline()).decode('utf-8', errors='replace')
 
-    encrypted_bytes = xor_crypt(text.encode('utf-8'), group_key)
-    payload = {
-        'type': 'text',
-        'from': f"K({MY_DISPLAY_ADDR})",
-        'text': encrypted_bytes.decode('latin-1') # Use latin-1 to preserve byte values
-    }
-    message_str = json.dumps(payload)
-
-    sent_to_any = False
-    failed_pcs = set()
-    for pc in pcs:
-        # Find the 'kqsp-chat' data channel (or similar)
-        channel = next((c for c in pc.sctp.dataChannels if c.label == 'kqsp-chat' and c.readyState == 'open'), None)
-        if channel:
+    try:
+        while True:
+            line = await read_line()
+            if not line:
+                await app.messages.put("[System] Input closed. Quitting...")
+                break
+            user_input = line.rstrip('\r\n')
             try:
-                channel.send(message_str)
-                sent_to_any = True
+                if user_input == '/quit':
+                    await app.messages.put("[System] Quitting...")
+                    break
+                elif user_input.startswith('/send '):
+                    await send_cli_file(user_input[len('/send '):].strip())
+                elif user_input == '/talk':
+                    if app.live_audio is None:
+                        await app.messages.put("[System] Live audio is off, start with --live-audio.")
+                    else:
+                        await app.messages.put("[Audio] Talking..." if app.live_audio.toggle() else "[Audio] Muted.")
+                elif user_input == '/stats':
+                    await collect_peer_rtts()
+                    await app.messages.put(metrics.render() or "[System] No metrics recorded yet.")
+                elif user_input.startswith('/'):
+                    await app.messages.put(f"[System] Unknown command: {user_input.split(' ')[0]}")
+                elif user_input:
+                    await send_cli_message(user_input)
             except Exception as e:
-                peer_id = get_peer_id(pc)
-                await message_queue.put(f"[System] Failed to send to {peer_id}: {e}")
-                failed_pcs.add(pc)
+                await app.messages.put(f"[System] Error handling input: {e}")
+    except (OSError, ValueError) as e:
+        await app.messages.put(f"[System] Error reading input: {e}. Quitting...")
+    finally:
+        if close_reader is not None:
+            close_reader()
+    app.stop_event.set()
+
+def build_text_frames(plaintext):
+    """Encrypts a text message once per format, returns (seq, make_binary, make_json) for broadcast_formats."""
+    seq = next_seq()
+
+    def make_binary(codec):
+        packed = compress_payload(codec, plaintext)
+        with metrics.timer('kqsp_encrypt_seconds'):
+            if packed is None:
+                return encode_frame(FRAME_TEXT, seq, xor_crypt(plaintext, relay_key))
+            return encode_frame(FRAME_TEXT | codec << FRAME_CODEC_SHIFT, seq, xor_crypt(packed, relay_key))
+
+    def make_json():
+        with metrics.timer('kqsp_encrypt_seconds'):
+            encrypted_bytes = xor_crypt(plaintext, group_key)
+        with metrics.timer('kqsp_json_encode_seconds'):
+            return json.dumps({
+                'type': 'text',
+                'from': f"K({MY_DISPLAY_ADDR})",
+                'text': encrypted_bytes.decode('latin-1') # Use latin-1 to preserve byte values
+            })
+
+    return seq, make_binary, make_json
+
+async def send_cli_message(text):
+    """Encrypts and sends a text message to all connected peers via data channels.
+
+    Returns {peer_id: None on success or the send exception}.
+    """
+    record_seq = None
+    if app.message_log is not None: # Logged even with nobody around, replayed when peers return
+        record_seq = app.message_log.append(RECORD_TEXT, text.encode('utf-8'))
+    channels = {p: c for p, c in app.mesh.chat_channels.items() if app.message_log is None or p not in app.message_log.replaying}
+    if not channels:
+        if record_seq is not None:
+            await app.messages.put(f"You: {text}")
+            await app.messages.put("[System] No active connections, message kept for delivery.")
         else:
-            peer_id = get_peer_id(pc)
-            await message_queue.put(f"[System] No open 'kqsp-chat' channel found for {peer_id}")
-            # Consider closing this pc if channel is missing/closed?
-            # failed_pcs.add(pc)
+            await app.messages.put("[System] No active connections to send message.")
+        return {}
+    if not group_key:
+        await app.messages.put("[System] Group key not yet established. Cannot send message.")
+        return {}
+
+    seq, make_binary, make_json = build_text_frames(text.encode('utf-8'))
+    results = await broadcast_formats(make_binary, make_json, channels)
+    for peer_id, result in results.items():
+        if result is not None:
+            await app.messages.put(f"[System] Failed to send to {peer_id}: {result}")
+        elif record_seq is not None:
+            app.message_log.sent(peer_id, record_seq, frame_seq=seq)
+    sent_to_any = any(result is None for result in results.values())
 
     if sent_to_any:
-         await message_queue.put(f"You: {text}") # Show own message
+         await app.messages.put(f"You: {text}") # Show own message
     else:
-         await message_queue.put("[System] Message could not be sent to any peer.")
-
-    # Clean up failed connections
-    # for pc in failed_pcs:
-    #     if pc in pcs:
-    #         await message_queue.put(f"[System] Closing failed connection {get_peer_id(pc)}")
-    #         pcs.discard(pc)
-    #         await pc.close()
+         await app.messages.put("[System] Message could not be sent to any peer.")
+    return results
 
 # --- Message Printing --- #
+def drain_message_queue():
+    """Takes everything currently queued, without waiting."""
+    batch = []
+    while True:
+        try:
+            batch.append(app.messages.get_nowait())
+        except asyncio.QueueEmpty:
+            return batch
+        app.messages.task_done()
+
+def write_messages(batch):
+    if batch:
+        sys.stdout.write('\n'.join(map(str, batch)) + '\n')
+        sys.stdout.flush()
+
 async def print_messages():
-    """Prints messages from the async queue."""
-    while not stop_event.is_set():
+    """Prints messages from the async queue.
+
+    Sleeps on the queue until something arrives (no polling), then writes
+    everything that has piled up in one go so bursts cost a single write.
+    Flushes what is left when cancelled at shutdown.
+    """
+    try:
+        while True:
+            batch = [await app.messages.get()]
+            app.messages.task_done()
+            batch.extend(drain_message_queue())
+            try:
+                write_messages(batch)
+            except Exception as e:
+                print(f"\n[System] Error printing message: {e}")
+    except asyncio.CancelledError:
+        write_messages(drain_message_queue())
+        raise
+
+# --- Daemon Mode / Control API --- #
+# With --daemon there is no TTY loop. Everything that would be printed goes to
+# the log and to any client streaming GET /messages, and local programs drive
+# the node over HTTP on a Unix socket (or 127.0.0.1 with --control-port):
+#
+#   curl --unix-socket kqsp.sock --json '{"text": "hi"}' http://kqsp/send
+#   curl --unix-socket kqsp.sock --json '{"path": "big.iso"}' http://kqsp/send-file
+#   curl --unix-socket kqsp.sock http://kqsp/peers
+#   curl --unix-socket kqsp.sock -N http://kqsp/messages
+#   curl --unix-socket kqsp.sock http://kqsp/stats
+#   curl --unix-socket kqsp.sock --json '{"talking": true}' http://kqsp/talk
+#
+# There is no login, so the API only answers local programs, never a web page
+# the user happens to have open: requests carrying an Origin header are
+# refused, POST bodies must be application/json (which a page can't send
+# cross-origin without a CORS preflight we never answer), and on the TCP port
+# the Host must be 127.0.0.1 or localhost, which defeats DNS rebinding.
+CONTROL_SUBSCRIBER_QUEUE = 1000 # Messages buffered per slow /messages client before dropping
+
+class ControlServer:
+    """Local HTTP control API for a headless node."""
+    def __init__(self):
+        self._subscribers = set() # asyncio.Queue per streaming /messages client
+
+    def app(self, port=None):
+        from aiohttp import web
+        hosts = {f"127.0.0.1:{port}", f"localhost:{port}"} if port else None
+
+        @web.middleware
+        async def local_only(request, handler):
+            if 'Origin' in request.headers:
+                return web.json_response({'error': 'browser requests are not accepted'}, status=403)
+            if hosts is not None and request.host not in hosts:
+                return web.json_response({'error': f'unexpected Host {request.host!r}'}, status=403)
+            if request.method == 'POST' and request.content_type != 'application/json':
+                return web.json_response({'error': 'expected Content-Type: application/json'}, status=415)
+            return await handler(request)
+
+        web_app = web.Application(middlewares=[local_only])
+        web_app.router.add_post('/send', self.handle_send)
+        web_app.router.add_post('/send-file', self.handle_send_file)
+        web_app.router.add_get('/peers', self.handle_peers)
+        web_app.router.add_get('/messages', self.handle_messages)
+        web_app.router.add_get('/stats', self.handle_stats)
+        web_app.router.add_post('/talk', self.handle_talk)
+        return web_app
+
+    async def pump_messages(self):
+        """Replaces print_messages: logs queued output and fans it out to subscribers."""
+        while True:
+            msg = await app.messages.get()
+            app.messages.task_done()
+            logging.info("%s", msg)
+            event = {'time': time.time(), 'message': str(msg)}
+            for queue in self._subscribers:
+                if queue.full(): # Slow reader, drop its oldest message
+                    queue.get_nowait()
+                queue.put_nowait(event)
+
+    async def handle_send(self, request):
+        from aiohttp import web
         try:
-            msg = await asyncio.wait_for(message_queue.get(), timeout=0.1)
-            # Simple print for now, could clear line like before if needed
-            print(msg)
-            message_queue.task_done()
-        except asyncio.TimeoutError:
-            continue
-        except Exception as e:
-            print(f"\n[System] Error printing message: {e}")
+            text = (await request.json())['text']
+        except (json.JSONDecodeError, KeyError, TypeError):
+            return web.json_response({'error': 'expected JSON body {"text": ...}'}, status=400)
+        results = await send_cli_message(text)
+        return web.json_response({
+            'sent': [peer_id for peer_id, result in results.items() if result is None],
+            'failed': {peer_id: str(result) for peer_id, result in results.items() if result is not None},
+        })
+
+    async def handle_send_file(self, request):
+        from aiohttp import web
+        try:
+            path = (await request.json())['path']
+        except (json.JSONDecodeError, KeyError, TypeError):
+            return web.json_response({'error': 'expected JSON body {"path": ...}'}, status=400)
+        # Progress streams back as NDJSON, one line per percent
+        response = web.StreamResponse(headers={'Content-Type': 'application/x-ndjson'})
+        await response.prepare(request)
+        last_percent = [-1]
+
+        async def progress(sent, size):
+            percent = sent * 100 // size if size else 100
+            if percent != last_percent[0]:
+                last_percent[0] = percent
+                await response.write(json.dumps({'sent': sent, 'size': size}).encode() + b'\n')
+
+        ok = await send_cli_file(path, progress)
+        await response.write(json.dumps({'done': ok}).encode() + b'\n')
+        await response.write_eof()
+        return response
+
+    async def handle_talk(self, request):
+        from aiohttp import web
+        if app.live_audio is None:
+            return web.json_response({'error': 'live audio is off, start with --live-audio'}, status=409)
+        try:
+            talking = (await request.json())['talking']
+        except (json.JSONDecodeError, KeyError, TypeError):
+            return web.json_response({'error': 'expected JSON body {"talking": true|false}'}, status=400)
+        if bool(talking) != app.live_audio.talking:
+            app.live_audio.toggle()
+        return web.json_response({'talking': app.live_audio.talking})
+
+    async def handle_peers(self, request):
+        from aiohttp import web
+        peers = []
+        for peer_id, pc in app.mesh.peers.items():
+            peers.append({
+                'peer_id': peer_id,
+                'state': pc.connectionState,
+                'chat_open': peer_id in app.mesh.chat_channels,
+                'capabilities': sorted(app.mesh.capabilities.get(peer_id, ())),
+            })
+        return web.json_response({'self': MY_PEER_ID, 'display': f"K({MY_DISPLAY_ADDR})", 'peers': peers})
+
+    async def handle_messages(self, request):
+        from aiohttp import web
+        response = web.StreamResponse(headers={'Content-Type': 'application/x-ndjson'})
+        await response.prepare(request)
+        queue = asyncio.Queue(maxsize=CONTROL_SUBSCRIBER_QUEUE)
+        self._subscribers.add(queue)
+        try:
+            while True:
+                event = await queue.get()
+                await response.write(json.dumps(event).encode() + b'\n')
+        except ConnectionResetError: # Client went away
+            pass
+        finally:
+            self._subscribers.discard(queue)
+        return response
+
+    async def handle_stats(self, request):
+        from aiohttp import web
+        await collect_peer_rtts()
+        return web.Response(text=metrics.render() + '\n', content_type='text/plain')
+
+def remove_stale_socket(path):
+    """Removes `path` if it's a Unix socket nobody is listening on.
+
+    Raises OSError if it's some other kind of file, or a running daemon
+    still accepts connections on it.
+    """
+    try:
+        mode = os.lstat(path).st_mode
+    except FileNotFoundError:
+        return
+    if not stat.S_ISSOCK(mode):
+        raise FileExistsError(errno.EEXIST, "Exists and is not a socket", path)
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(path)
+    except ConnectionRefusedError:
+        os.remove(path) # Stale socket from a previous run
+        return
+    finally:
+        probe.close()
+    raise OSError(errno.EADDRINUSE, "Another daemon is listening on", path)
+
+async def start_control_server(control, socket_path=None, port=None):
+    from aiohttp import web
+    runner = web.AppRunner(control.app(port))
+    await runner.setup()
+    if port:
+        site = web.TCPSite(runner, '127.0.0.1', port)
+        where = f"http://127.0.0.1:{port}"
+    else:
+        remove_stale_socket(socket_path)
+        site = web.UnixSite(runner, socket_path)
+        where = f"unix:{socket_path}"
+    await site.start()
+    await app.messages.put(f"[System] Control API listening on {where}")
+    return runner
 
 # --- Main Execution --- #
 async def main(args):
+    global app
+    app = App(log_signals=args.log_signals, compression=not args.no_compression, relay=args.relay)
+    load_numpy()
+    if args.message_log:
+        app.message_log = MessageLog(args.message_log)
+        print(f"Message log: {args.message_log} (up to seq {app.message_log.last_seq})")
+    if args.live_audio:
+        try:
+            app.live_audio = LiveAudio(args.audio_input, args.audio_input_format)
+        except (ImportError, OSError, ValueError) as e: # Missing PyAV or an unusable input
+            print(f"[System] Live audio unavailable: {e}")
     print("--- Kazan's Quick Share Protocol (CLI - WebRTC) ---")
     print(f"Your PeerID: {MY_PEER_ID}")
 
@@ -421,45 +2683,70 @@ async def main(args):
         # Fallback to basic signaling if no URL provided
         print(f"Signaling Server (Basic): {args.signaling} {args.signaling_host}:{args.signaling_port}")
         print(f"Role: {args.role}")
-        signaling = basic_create_signaling(args)
+        from aiortc.contrib.signaling import create_signaling
+        signaling = create_signaling(args)
         role = args.role
 
     print("Connecting to signaling server...")
     print("--------------------------------------------------")
 
-    # Create peer connection
-    # Need global pc for WebSocket callback access, or pass it differently
-    global pc
-    pc = RTCPeerConnection()
-    pcs.add(pc)
-
     # Start background tasks
-    print_task = asyncio.create_task(print_messages())
-    input_task = asyncio.create_task(consume_user_input())
+    control_runner = None
+    if args.daemon:
+        # Headless: no TTY loops, output goes to the log and the control API
+        control = ControlServer()
+        print_task = asyncio.create_task(control.pump_messages())
+        input_task = None
+        loop = asyncio.get_running_loop()
+        for signame in ('SIGINT', 'SIGTERM'):
+            try:
+                loop.add_signal_handler(getattr(signal, signame), app.stop_event.set)
+            except (NotImplementedError, AttributeError): # Windows
+                pass
+    else:
+        print_task = asyncio.create_task(print_messages())
+        input_task = asyncio.create_task(consume_user_input())
+    metrics_task = asyncio.create_task(write_metrics_jsonl(args.metrics_jsonl)) if args.metrics_jsonl else None
 
     # Run main connection logic
     try:
-        await run(pc=pc, signaling=signaling, role=role, target_peer=args.target_peer if args.signaling_url else None)
+        if args.daemon:
+            control_runner = await start_control_server(control, args.control_socket, args.control_port)
+        target_peers = [p.strip() for p in args.target_peer.split(',') if p.strip()] if args.signaling_url and args.target_peer else []
+        await run(signaling=signaling, role=role, target_peers=target_peers)
     except Exception as e:
         print(f"[System] Main execution error: {e}")
     finally:
         print("[System] Cleaning up...")
-        if not stop_event.is_set():
-             stop_event.set() # Ensure stop event is set on exit
+        if not app.stop_event.is_set():
+             app.stop_event.set() # Ensure stop event is set on exit
 
         # Close signaling and connections
         await signaling.close()
-        coros = [p.close() for p in pcs]
-        await asyncio.gather(*coros, return_exceptions=True)
-        pcs.clear()
+        await app.mesh.close()
+        app.receive_pipeline.close()
+        if app.message_log is not None:
+            app.message_log.close()
+        if app.live_audio is not None:
+            await app.live_audio.close()
+        app.close()
 
         # Cancel background tasks
-        input_task.cancel()
+        if metrics_task:
+            metrics_task.cancel()
+            try:
+                await metrics_task
+            except asyncio.CancelledError:
+                pass
+        if control_runner:
+            await control_runner.cleanup()
+        if input_task:
+            input_task.cancel()
+            try:
+                await input_task
+            except asyncio.CancelledError:
+                pass
         print_task.cancel()
-        try:
-            await input_task
-        except asyncio.CancelledError:
-            pass
         try:
             await print_task
         except asyncio.CancelledError:
@@ -468,6 +2755,11 @@ async def main(args):
     print("[System] Exited.")
 
 if __name__ == "__main__":
+    # `kqsp_cli.py bench ...` runs the benchmark suite instead of the client
+    if len(sys.argv) > 1 and sys.argv[1] == 'bench':
+        import kqsp_bench
+        sys.exit(kqsp_bench.main(sys.argv[2:]))
+
     # Setup logging
     logging.basicConfig(level=logging.INFO)
     logging.getLogger("aiortc").setLevel(logging.WARNING)
@@ -488,10 +2780,23 @@ if __name__ == "__main__":
 
     # Add WebSocket signaling arguments
     parser.add_argument('--signaling-url', help='URL of the WebSocket signaling server (e.g., wss://host:port/path)')
-    parser.add_argument('--target-peer', help='Peer ID to connect to when offering via WebSocket')
+    parser.add_argument('--target-peer', help='Peer ID(s) to connect to when offering via WebSocket, comma-separated')
 
     # Add any KQSP specific arguments here if needed
     # parser.add_argument('--my-arg', help='Example KQSP argument')
+    parser.add_argument('--log-signals', action='store_true', help='Print every received signaling frame')
+    parser.add_argument('--live-audio', action='store_true', help='Carry push-to-talk voice on an audio track (/talk toggles it)')
+    parser.add_argument('--audio-input', help='Microphone device or audio file for --live-audio (default: silence)')
+    parser.add_argument('--audio-input-format', help='Input format for --audio-input devices, e.g. pulse, alsa, avfoundation')
+    parser.add_argument('--relay', action='store_true', help='Forward messages between peers that are not directly connected')
+    parser.add_argument('--message-log', metavar='DIR', help="Keep the group's sent messages in DIR and redeliver them to peers that reconnect")
+    parser.add_argument('--no-compression', action='store_true', help="Don't offer or send compressed payloads")
+    parser.add_argument('--metrics-jsonl', help='Append a metrics snapshot to this JSONL file periodically')
+
+    # Headless operation
+    parser.add_argument('--daemon', action='store_true', help='Run without the interactive console, controlled over a local API')
+    parser.add_argument('--control-socket', default='kqsp.sock', help='Unix socket path for the daemon control API')
+    parser.add_argument('--control-port', type=int, help='Serve the daemon control API on 127.0.0.1:PORT instead of a Unix socket')
 
     args = parser.parse_args()
 
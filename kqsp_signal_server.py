@@ -0,0 +1,269 @@
+"""Local PeerJS-style signaling server for KQSP, plus a load driver.
+
+Speaks the same message set as the CLI's WebSocketSignaling: OPEN, OFFER,
+ANSWER, CANDIDATE, LEAVE and EXPIRE. Every frame is routed by its `dst` with
+one dict lookup.
+
+    python kqsp_signal_server.py serve --port 9000
+    python kqsp_cli.py --signaling-url ws://127.0.0.1:9000/
+
+    python kqsp_signal_server.py load --peers 500 --messages 20
+
+`load` starts an in-process server (or targets --url) and spins up hundreds of
+simulated CLI peers that register, trade OFFER/ANSWER/CANDIDATE frames in
+pairs and then flood each other. It prints connect latency percentiles and
+routed messages/sec as JSON.
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+
+import aiohttp
+from aiohttp import web
+
+PENDING_TTL = 5.0 # Seconds to hold frames for a peer that hasn't registered yet
+PENDING_MAX = 64  # Frames held per unregistered peer
+
+# --- Server ---
+class SignalingServer:
+    """Routes signaling frames between registered peers by `dst`."""
+    def __init__(self):
+        self.peers = {}   # peer_id -> WebSocketResponse
+        self.pending = {} # peer_id -> [(expires_at, frame)] for peers not registered yet
+        self.routed = 0
+
+    def app(self):
+        app = web.Application()
+        app.router.add_get('/', self.handle_socket)
+        app.router.add_get('/peerjs', self.handle_socket) # PeerJS clients connect here
+        return app
+
+    async def handle_socket(self, request):
+        ws = web.WebSocketResponse(heartbeat=30)
+        await ws.prepare(request)
+        peer_id = request.query.get('id') # PeerJS passes the ID in the query string
+        if peer_id:
+            await self._register(peer_id, ws)
+        try:
+            async for msg in ws:
+                if msg.type != aiohttp.WSMsgType.TEXT:
+                    continue
+                try:
+                    frame = json.loads(msg.data)
+                except json.JSONDecodeError:
+                    continue
+                if not isinstance(frame, dict):
+                    continue
+                if frame.get('type') == 'OPEN':
+                    peer_id = frame.get('src')
+                    if peer_id:
+                        await self._register(peer_id, ws)
+                elif peer_id:
+                    frame['src'] = peer_id # Never trust a client-supplied source
+                    await self.route(frame)
+        finally:
+            if peer_id and self.peers.get(peer_id) is ws:
+                del self.peers[peer_id]
+        return ws
+
+    async def _register(self, peer_id, ws):
+        old = self.peers.get(peer_id)
+        self.peers[peer_id] = ws
+        if old is not None and old is not ws:
+            await old.close() # Latest connection for an ID wins
+        await ws.send_json({'type': 'OPEN'})
+        now = time.monotonic()
+        for expires_at, frame in self.pending.pop(peer_id, []):
+            if expires_at > now:
+                await self._deliver(ws, frame)
+
+    async def route(self, frame):
+        dst = frame.get('dst')
+        ws = self.peers.get(dst)
+        if ws is not None:
+            await self._deliver(ws, frame)
+        elif frame.get('type') in ('OFFER', 'ANSWER', 'CANDIDATE'):
+            # Hold briefly in case dst is still connecting, else tell the sender
+            queue = self.pending.setdefault(dst, [])
+            if len(queue) < PENDING_MAX:
+                queue.append((time.monotonic() + PENDING_TTL, frame))
+                asyncio.get_running_loop().call_later(PENDING_TTL, self._expire, dst, frame)
+
+    async def _deliver(self, ws, frame):
+        try:
+            await ws.send_json(frame)
+            self.routed += 1
+        except ConnectionResetError:
+            pass
+
+    def _expire(self, dst, frame):
+        queue = self.pending.get(dst)
+        if not queue:
+            return
+        remaining = [(t, f) for t, f in queue if f is not frame]
+        if len(remaining) == len(queue): # Already delivered on registration
+            return
+        if remaining:
+            self.pending[dst] = remaining
+        else:
+            del self.pending[dst]
+        sender = self.peers.get(frame.get('src'))
+        if sender is not None:
+            asyncio.create_task(self._deliver(sender, {'type': 'EXPIRE', 'src': dst, 'dst': frame.get('src')}))
+
+async def start_server(host, port):
+    server = SignalingServer()
+    runner = web.AppRunner(server.app())
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    return server, runner
+
+# --- Load Driver ---
+def percentiles(samples):
+    if not samples:
+        return {}
+    ordered = sorted(samples)
+    def pick(q):
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000
+    return {'p50_ms': pick(0.50), 'p90_ms': pick(0.90), 'p99_ms': pick(0.99), 'max_ms': ordered[-1] * 1000}
+
+class SimulatedPeer:
+    """Signaling-side stand-in for a CLI node: registers, answers offers, counts frames."""
+    def __init__(self, peer_id, sdp_size):
+        self.peer_id = peer_id
+        self.ws = None
+        self.received = 0
+        self.answered = {} # dst -> future resolved by the ANSWER
+        self._fake_sdp = 'v=0\r\n' + 'a=x\r\n' * (sdp_size // 6)
+        self._task = None
+
+    async def connect(self, session, url):
+        start = time.perf_counter()
+        self.ws = await session.ws_connect(url)
+        await self.ws.send_json({'type': 'OPEN', 'src': self.peer_id})
+        while True: # Registered once the server acknowledges with OPEN
+            msg = await self.ws.receive()
+            if msg.type == aiohttp.WSMsgType.TEXT and json.loads(msg.data).get('type') == 'OPEN':
+                break
+            if msg.type in (aiohttp.WSMsgType.CLOSED, aiohttp.WSMsgType.ERROR):
+                raise ConnectionError(f"{self.peer_id} closed during registration")
+        self._task = asyncio.create_task(self._receive_loop())
+        return time.perf_counter() - start
+
+    async def _receive_loop(self):
+        async for msg in self.ws:
+            if msg.type != aiohttp.WSMsgType.TEXT:
+                continue
+            frame = json.loads(msg.data)
+            self.received += 1
+            if frame['type'] == 'OFFER':
+                await self.ws.send_json({'type': 'ANSWER', 'dst': frame['src'], 'src': self.peer_id,
+                                         'payload': {'type': 'answer', 'sdp': self._fake_sdp}})
+            elif frame['type'] == 'ANSWER':
+                future = self.answered.pop(frame['src'], None)
+                if future and not future.done():
+                    future.set_result(time.perf_counter())
+
+    async def negotiate(self, dst, candidates=3):
+        """Sends an OFFER plus trickled candidates, returns the time until the ANSWER arrives."""
+        future = asyncio.get_running_loop().create_future()
+        self.answered[dst] = future
+        start = time.perf_counter()
+        await self.ws.send_json({'type': 'OFFER', 'dst': dst, 'src': self.peer_id,
+                                 'payload': {'type': 'offer', 'sdp': self._fake_sdp}})
+        for i in range(candidates):
+            await self.ws.send_json({'type': 'CANDIDATE', 'dst': dst, 'src': self.peer_id, 'payload': {
+                'candidate': {'candidate': f'candidate:{i} 1 udp 2130706431 10.0.0.1 {50000 + i} typ host', 'sdpMid': '0', 'sdpMLineIndex': 0},
+                'type': 'candidate'}})
+        return await asyncio.wait_for(future, 30) - start
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+        if self.ws:
+            await self.ws.close()
+
+async def run_load(url, peers, messages, sdp_size):
+    connector = aiohttp.TCPConnector(limit=0)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        nodes = [SimulatedPeer(f"load-{i}-{os.urandom(3).hex()}", sdp_size) for i in range(peers)]
+        connect_times = await asyncio.gather(*(node.connect(session, url) for node in nodes))
+        try:
+            # Pair peers up (0->1, 2->3, ...) and negotiate like the CLI would
+            pairs = [(nodes[i], nodes[i + 1]) for i in range(0, len(nodes) - 1, 2)]
+            negotiate_times = await asyncio.gather(*(a.negotiate(b.peer_id) for a, b in pairs))
+
+            # Flood: every peer sends `messages` frames to its neighbour
+            for node in nodes:
+                node.received = 0
+            expected = messages * len(nodes)
+            start = time.perf_counter()
+            async def flood(node, dst):
+                for _ in range(messages):
+                    await node.ws.send_json({'type': 'CANDIDATE', 'dst': dst, 'src': node.peer_id, 'payload': {'candidate': None, 'type': 'candidate'}})
+            await asyncio.gather(*(flood(node, nodes[(i + 1) % len(nodes)].peer_id) for i, node in enumerate(nodes)))
+            while sum(node.received for node in nodes) < expected and time.perf_counter() - start < 60:
+                await asyncio.sleep(0.01)
+            elapsed = time.perf_counter() - start
+            delivered = sum(node.received for node in nodes)
+        finally:
+            await asyncio.gather(*(node.close() for node in nodes), return_exceptions=True)
+    return {
+        'peers': peers,
+        'connect_latency': percentiles(connect_times),
+        'negotiate_latency': percentiles(negotiate_times),
+        'flood_messages': expected,
+        'flood_delivered': delivered,
+        'messages_per_s': delivered / elapsed if elapsed else 0.0,
+    }
+
+# --- Entry Point ---
+async def serve(host, port):
+    server, runner = await start_server(host, port)
+    print(f"KQSP signaling server listening on ws://{host}:{port}/")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+async def load(args):
+    runner = None
+    url = args.url
+    if not url:
+        _, runner = await start_server('127.0.0.1', args.port)
+        url = f"ws://127.0.0.1:{args.port}/"
+    try:
+        return await run_load(url, args.peers, args.messages, args.sdp_size)
+    finally:
+        if runner:
+            await runner.cleanup()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="KQSP local signaling server and load driver")
+    sub = parser.add_subparsers(dest='command', required=True)
+    serve_parser = sub.add_parser('serve', help='Run the signaling server')
+    serve_parser.add_argument('--host', default='127.0.0.1', help='Address to listen on')
+    serve_parser.add_argument('--port', type=int, default=9000, help='Port to listen on')
+    load_parser = sub.add_parser('load', help='Simulate many CLI peers against a server')
+    load_parser.add_argument('--url', help='Server to load (default: start one in-process)')
+    load_parser.add_argument('--port', type=int, default=9001, help='Port for the in-process server')
+    load_parser.add_argument('--peers', type=int, default=200, help='Number of simulated peers')
+    load_parser.add_argument('--messages', type=int, default=20, help='Frames each peer sends in the flood phase')
+    load_parser.add_argument('--sdp-size', type=int, default=2000, help='Bytes of fake SDP per OFFER/ANSWER')
+    args = parser.parse_args(argv)
+
+    try:
+        if args.command == 'serve':
+            asyncio.run(serve(args.host, args.port))
+        else:
+            print(json.dumps(asyncio.run(load(args)), indent=2))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())